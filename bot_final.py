@@ -1,14 +1,27 @@
 import os
+import asyncio
 import json
 import base64
+import hashlib
+import itertools
+import queue
 import time
-import requests
 import logging
 import re
 import random
-from dataclasses import dataclass, field
+import sqlite3
+import ssl
+import sys
+import threading
+import zlib
+from array import array
+from io import BytesIO
+from bisect import bisect_left, insort
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from functools import lru_cache
+from functools import lru_cache, partial, wraps
 from typing import Optional
 
 from telegram import (
@@ -28,8 +41,14 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
 )
+import httplib2
+import httpx
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
+from PIL import Image, ImageOps
 
 # ============================================
 # CONFIGURACIÓN - VARIABLES DE ENTORNO RAILWAY
@@ -40,6 +59,24 @@ GOOGLE_SHEETS_ID = os.getenv("GOOGLE_SHEETS_ID")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 TU_CHAT_ID = os.getenv("TU_CHAT_ID")
 GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
+# Directorio persistente (volumen) para el snapshot y la caché de extracciones. /tmp no
+# sirve: se vacía en cada deploy y cualquiera puede escribir ahí. Sin él, el snapshot se
+# desactiva y las extracciones se cachean solo en memoria.
+DATOS_DIR = os.getenv("DATOS_DIR") or os.getenv("RAILWAY_VOLUME_MOUNT_PATH")
+SNAPSHOT_PATH = os.path.join(DATOS_DIR, "compras_snapshot.bin") if DATOS_DIR else None
+EXTRACCIONES_DB_PATH = os.path.join(DATOS_DIR, "extracciones.db") if DATOS_DIR else ":memory:"
+GEMINI_CONCURRENCIA = int(os.getenv("GEMINI_CONCURRENCIA", "3"))
+IMAGEN_LADO_MAX = int(os.getenv("IMAGEN_LADO_MAX", "1600"))
+IMAGEN_BYTES_OBJETIVO = int(os.getenv("IMAGEN_BYTES_OBJETIVO", "350000"))
+IMAGEN_WORKERS = int(os.getenv("IMAGEN_WORKERS", "2"))
+EXTRACCIONES_MAX = int(os.getenv("EXTRACCIONES_MAX", "2000"))
+ALBUM_ESPERA = float(os.getenv("ALBUM_ESPERA", "1.5"))
+ALBUM_CONCURRENCIA = int(os.getenv("ALBUM_CONCURRENCIA", "4"))
+ARCHIVO_HOJA = os.getenv("ARCHIVO_HOJA", "Archivo")
+ARCHIVO_DIAS = int(os.getenv("ARCHIVO_DIAS", "90"))
+SHEETS_CUOTA_MINUTO = int(os.getenv("SHEETS_CUOTA_MINUTO", "60"))
+SHEETS_WORKERS = int(os.getenv("SHEETS_WORKERS", "4"))
+LECTURA_BLOQUE = int(os.getenv("LECTURA_BLOQUE", "5000"))
 
 logger = logging.getLogger(__name__)
 
@@ -74,6 +111,7 @@ METODOS_PAGO: dict[str, str] = {
 
 ID_COMPLETO_RE = re.compile(r"^\d{3}-\d{7}-\d{7}$")
 ID_RE = re.compile(r"ID:\s*([0-9]{3}-[0-9]{7}-[0-9]{7})")
+TOKEN_RE = re.compile(r"\w+")
 
 MENU_BOTONES = {"📸 COMPRA", "💰 VENTA", "📝 REVIEW", "🗑️ ELIMINAR", "📦 INVENTARIO", "❓ AYUDA"}
 
@@ -86,21 +124,353 @@ def extraer_id_desde_texto(texto: str) -> Optional[str]:
 
 
 # ============================================
-# DATACLASS COMPRA
+# TABLA DE COMPRAS (COLUMNAR) Y VISTA COMPRA
 # ============================================
 
-@dataclass
+# ✅ MEJORA: la caché ya no guarda listas de strings por fila. Cada columna vive en
+# un contenedor compacto (array/bytearray) y Compra es solo una vista sobre una fila.
+(COL_ID, COL_FECHA_COMPRA, COL_PRODUCTO, COL_PRECIO_COMPRA, COL_FECHA_DEV,
+ COL_FECHA_VENTA, COL_PRECIO_VENTA, COL_METODO, COL_ESTADO) = range(9)
+NUM_COLUMNAS = 9
+
+ESTADOS = ("", "pendiente", "vendido", "devuelto")
+ESTADO_VACIO, ESTADO_PENDIENTE, ESTADO_VENDIDO, ESTADO_DEVUELTO = range(4)
+_CODIGO_ESTADO = {estado: codigo for codigo, estado in enumerate(ESTADOS)}
+
+SIN_PRECIO = -(2 ** 63)  # centinela de celda de precio vacía en array('q')
+SIN_FECHA_DIAS = 9999  # días restantes de una fila sin fecha de devolución válida
+_SIN_FECHA_ORDEN = 2 ** 31 - 1  # las filas sin fecha van al final de su grupo
+
+_TIPOS_COLUMNA = ("texto", "fecha", "texto", "precio", "fecha", "fecha", "precio", "texto", "estado")
+
+
+@lru_cache(maxsize=8192)
+def _fecha_a_ordinal(texto: str) -> Optional[int]:
+    """'dd/mm/YYYY' → ordinal del día; 0 si está vacía; None si no es una fecha."""
+    if not texto:
+        return 0
+    try:
+        return datetime.strptime(texto, "%d/%m/%Y").toordinal()
+    except ValueError:
+        return None
+
+
+def _ordinal_a_fecha(ordinal: int) -> str:
+    return datetime.fromordinal(ordinal).strftime("%d/%m/%Y") if ordinal else ""
+
+
+def _hoy() -> int:
+    return datetime.now().toordinal()
+
+
+def _dias_desde_ordinal(ordinal: int, hoy: int) -> int:
+    """Igual que (fecha_dev - datetime.now()).days; SIN_FECHA_DIAS si no hay fecha."""
+    return ordinal - hoy - 1 if ordinal else SIN_FECHA_DIAS
+
+
+def _dias_hasta(fecha_str: str) -> int:
+    """Días restantes hasta una fecha 'dd/mm/YYYY' suelta (p. ej. de user_data)."""
+    return _dias_desde_ordinal(_fecha_a_ordinal(fecha_str or "") or 0, _hoy())
+
+
+def _precio_a_codigo(texto: str) -> Optional[int]:
+    """
+    Precio en texto → código para array('q'): centavos * 2, + 1 si viene en formato
+    moneda de Sheets ("$1,299.99"). SIN_PRECIO si está vacío. None si el código no
+    vuelve a dar exactamente el mismo texto ("12,50", "US$ 5", "7.5"...) o no cabe en
+    el array: esas celdas van a `crudos` tal cual.
+    """
+    if not texto:
+        return SIN_PRECIO
+    moneda = texto.startswith("$")
+    try:
+        centavos = round(float(texto[1:].replace(",", "") if moneda else texto) * 100)
+    except (ValueError, OverflowError):
+        return None
+    codigo = centavos * 2 + moneda
+    if not SIN_PRECIO < codigo < 2 ** 63 or _codigo_a_precio(codigo) != texto:
+        return None
+    return codigo
+
+
+def _codigo_a_precio(codigo: int) -> str:
+    if codigo == SIN_PRECIO:
+        return ""
+    centavos, moneda = divmod(codigo, 2)
+    if moneda:
+        return f"${centavos / 100:,.2f}"
+    texto = f"{centavos / 100:.2f}"
+    return texto[:-3] if texto.endswith(".00") else texto
+
+
+def parse_precio(valor: str) -> float:
+    if not valor:
+        return 0.0
+    limpio = valor.replace("US$", "").replace("$", "").replace(",", "").strip()
+    try:
+        return float(limpio)
+    except ValueError:
+        return 0.0
+
+
+class TablaCompras:
+    """
+    Filas de la hoja en formato columnar: fechas como ordinales (array 'i'), precios
+    como código de centavos (array 'q', ver _precio_a_codigo), estado como entero
+    pequeño y textos internados.
+    El índice i corresponde a la fila i + 1 de Sheets (0 = cabecera). Las celdas que
+    no encajan en su tipo (p. ej. "NO_ENCONTRADO" en una fecha) se guardan tal cual
+    en `crudos` para no perder nada al volver a texto.
+    Los días restantes hasta la devolución también se guardan precalculados (`dias`)
+    y solo se recalculan al cambiar de día (actualizar_dia) o al parchear la fecha.
+    """
+
+    __slots__ = ("ids", "fechas_compra", "productos", "precios_compra", "fechas_dev",
+                 "fechas_venta", "precios_venta", "metodos", "estados", "vacias", "crudos",
+                 "dias", "hoy")
+
+    # Contenedor de cada columna, en el orden de la hoja
+    _COLUMNAS = ("ids", "fechas_compra", "productos", "precios_compra", "fechas_dev",
+                 "fechas_venta", "precios_venta", "metodos", "estados")
+    # Para el snapshot: columnas de texto (van en JSON) y numéricas (van como bytes)
+    _TEXTOS = ("ids", "productos", "metodos")
+    _NUMERICAS = ("fechas_compra", "precios_compra", "fechas_dev", "fechas_venta",
+                  "precios_venta", "estados", "vacias")
+
+    def __init__(self) -> None:
+        self.ids: list[str] = []
+        self.fechas_compra = array("i")
+        self.productos: list[str] = []
+        self.precios_compra = array("q")
+        self.fechas_dev = array("i")
+        self.fechas_venta = array("i")
+        self.precios_venta = array("q")
+        self.metodos: list[str] = []
+        self.estados = bytearray()
+        self.vacias = bytearray()
+        self.crudos: dict[tuple[int, int], str] = {}
+        self.dias = array("i")
+        self.hoy = _hoy()
+
+    @classmethod
+    def desde_filas(cls, filas: list) -> "TablaCompras":
+        tabla = cls()
+        for row in filas:
+            tabla.anexar(row)
+        return tabla
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def volcar(self) -> tuple[dict, bytes]:
+        """
+        Copia de la tabla para el snapshot: cabecera apta para JSON (textos, `crudos` y
+        cómo trocear el binario) y las columnas numéricas tal cual están en memoria.
+        Solo copia, así que puede hacerse con el lock y codificarse después fuera.
+        """
+        cabecera = {
+            "filas": len(self.ids),
+            "byteorder": sys.byteorder,
+            "textos": {nombre: list(getattr(self, nombre)) for nombre in self._TEXTOS},
+            "crudos": [[i, col, texto] for (i, col), texto in self.crudos.items()],
+            "numericas": [],
+        }
+        trozos = []
+        for nombre in self._NUMERICAS:
+            columna = getattr(self, nombre)
+            datos = columna.tobytes() if isinstance(columna, array) else bytes(columna)
+            cabecera["numericas"].append([nombre, getattr(columna, "typecode", "B"), len(datos)])
+            trozos.append(datos)
+        return cabecera, b"".join(trozos)
+
+    @classmethod
+    def restaurar(cls, cabecera: dict, binario: bytes) -> "TablaCompras":
+        """Inversa de volcar(). ValueError si el contenido no cuadra con esta versión."""
+        tabla = cls()
+        n = cabecera["filas"]
+        for nombre in cls._TEXTOS:
+            columna = [sys.intern(texto) for texto in cabecera["textos"][nombre]]
+            if len(columna) != n:
+                raise ValueError(f"columna {nombre}: {len(columna)} filas, se esperaban {n}")
+            setattr(tabla, nombre, columna)
+        if [nombre for nombre, _, _ in cabecera["numericas"]] != list(cls._NUMERICAS):
+            raise ValueError("columnas numéricas distintas")
+        inicio = 0
+        for nombre, typecode, tam in cabecera["numericas"]:
+            trozo = binario[inicio:inicio + tam]
+            inicio += tam
+            vacia = getattr(tabla, nombre)
+            if getattr(vacia, "typecode", "B") != typecode:
+                raise ValueError(f"columna {nombre}: tipo {typecode}")
+            if isinstance(vacia, array):
+                columna = array(typecode)
+                columna.frombytes(trozo)
+                if cabecera["byteorder"] != sys.byteorder:
+                    columna.byteswap()
+            else:
+                columna = bytearray(trozo)
+            if len(columna) != n:
+                raise ValueError(f"columna {nombre}: {len(columna)} filas, se esperaban {n}")
+            setattr(tabla, nombre, columna)
+        tabla.crudos = {(i, col): texto for i, col, texto in cabecera["crudos"]}
+        tabla.dias = array("i", (_dias_desde_ordinal(o, tabla.hoy) for o in tabla.fechas_dev))
+        return tabla
+
+    def anexar(self, row: list) -> None:
+        i = len(self.ids)
+        self.ids.append("")
+        self.productos.append("")
+        self.metodos.append("")
+        self.fechas_compra.append(0)
+        self.fechas_dev.append(0)
+        self.fechas_venta.append(0)
+        self.precios_compra.append(SIN_PRECIO)
+        self.precios_venta.append(SIN_PRECIO)
+        self.estados.append(ESTADO_VACIO)
+        self.vacias.append(0 if row else 1)
+        self.dias.append(SIN_FECHA_DIAS)
+        for col, valor in enumerate(row[:NUM_COLUMNAS]):
+            self._poner(i, col, valor)
+
+    def actualizar_dia(self, hoy: int) -> None:
+        """Recalcula `dias` si ha cambiado la fecha desde el último cálculo."""
+        if hoy == self.hoy:
+            return
+        self.hoy = hoy
+        self.dias = array("i", (_dias_desde_ordinal(o, hoy) for o in self.fechas_dev))
+
+    def actualizar(self, i: int, col_inicio: int, valores: list) -> None:
+        for k, valor in enumerate(valores):
+            self._poner(i, col_inicio + k, valor)
+        self.vacias[i] = 0
+
+    def _poner(self, i: int, col: int, valor) -> None:
+        texto = valor if isinstance(valor, str) else str(valor)
+        self.crudos.pop((i, col), None)
+        columna = getattr(self, self._COLUMNAS[col])
+        tipo = _TIPOS_COLUMNA[col]
+        if tipo == "texto":
+            columna[i] = sys.intern(texto)
+            return
+        if tipo == "fecha":
+            codigo, vacio = _fecha_a_ordinal(texto), 0
+        elif tipo == "precio":
+            codigo, vacio = _precio_a_codigo(texto), SIN_PRECIO
+        else:
+            codigo, vacio = _CODIGO_ESTADO.get(texto), ESTADO_VACIO
+        try:
+            if codigo is not None:
+                columna[i] = codigo
+        except OverflowError:  # no cabe en el tipo del array
+            codigo = None
+        if codigo is None:
+            self.crudos[(i, col)] = texto
+            codigo = columna[i] = vacio
+        if col == COL_FECHA_DEV:
+            self.dias[i] = _dias_desde_ordinal(codigo, self.hoy)
+
+    def celda(self, i: int, col: int) -> str:
+        crudo = self.crudos.get((i, col))
+        if crudo is not None:
+            return crudo
+        valor = getattr(self, self._COLUMNAS[col])[i]
+        tipo = _TIPOS_COLUMNA[col]
+        if tipo == "texto":
+            return valor
+        if tipo == "fecha":
+            return _ordinal_a_fecha(valor)
+        if tipo == "precio":
+            return _codigo_a_precio(valor)
+        return ESTADOS[valor]
+
+    def fila(self, i: int) -> list[str]:
+        """Fila i como lista de strings, igual que la devolvería Sheets."""
+        if self.vacias[i]:
+            return []
+        row = [self.celda(i, col) for col in range(NUM_COLUMNAS)]
+        while row and not row[-1]:
+            row.pop()
+        return row
+
+    def estado(self, i: int) -> str:
+        return self.celda(i, COL_ESTADO) or "pendiente"
+
+    def prioridad(self, i: int) -> tuple[int, int]:
+        return _prioridad_estado(self.estados[i], self.dias[i])
+
+    def clave_orden(self, i: int) -> tuple[int, int, int]:
+        """(grupo, fecha de devolución, i): mismo orden que prioridad() pero sin depender de hoy."""
+        grupo = _prioridad_estado(self.estados[i], 0)[0]
+        return grupo, self.fechas_dev[i] or _SIN_FECHA_ORDEN, i
+
+    def sin_filas(self, quitar: set[int]) -> "TablaCompras":
+        """Copia de la tabla sin las filas indicadas (las vistas existentes siguen válidas)."""
+        conservar = [i for i in range(len(self.ids)) if i not in quitar]
+        nueva = TablaCompras()
+        nueva.hoy = self.hoy
+        for nombre in self._COLUMNAS + ("vacias", "dias"):
+            origen = getattr(self, nombre)
+            getattr(nueva, nombre).extend(origen[i] for i in conservar)
+        nuevo_indice = {viejo: nuevo for nuevo, viejo in enumerate(conservar)}
+        nueva.crudos = {
+            (nuevo_indice[i], col): texto
+            for (i, col), texto in self.crudos.items() if i in nuevo_indice
+        }
+        return nueva
+
+
 class Compra:
-    fila: int
-    id: str
-    fecha_compra: str
-    producto: str
-    precio_compra: str
-    fecha_devolucion: str
-    fecha_venta: str = ""
-    precio_venta: str = ""
-    metodo_pago: str = ""
-    estado: str = "pendiente"
+    """Vista de solo lectura sobre una fila de TablaCompras (no copia datos)."""
+
+    __slots__ = ("_tabla", "_i")
+
+    def __init__(self, tabla: TablaCompras, i: int) -> None:
+        self._tabla = tabla
+        self._i = i
+
+    @property
+    def fila(self) -> int:
+        return self._i + 1
+
+    @property
+    def id(self) -> str:
+        return self._tabla.ids[self._i]
+
+    @property
+    def fecha_compra(self) -> str:
+        return self._tabla.celda(self._i, COL_FECHA_COMPRA)
+
+    @property
+    def producto(self) -> str:
+        return self._tabla.productos[self._i]
+
+    @property
+    def precio_compra(self) -> str:
+        return self._tabla.celda(self._i, COL_PRECIO_COMPRA) or "0"
+
+    @property
+    def fecha_devolucion(self) -> str:
+        return self._tabla.celda(self._i, COL_FECHA_DEV)
+
+    @property
+    def fecha_venta(self) -> str:
+        return self._tabla.celda(self._i, COL_FECHA_VENTA)
+
+    @property
+    def precio_venta(self) -> str:
+        return self._tabla.celda(self._i, COL_PRECIO_VENTA)
+
+    @property
+    def metodo_pago(self) -> str:
+        return self._tabla.metodos[self._i]
+
+    @property
+    def estado(self) -> str:
+        return self._tabla.estado(self._i)
+
+    @property
+    def dias(self) -> int:
+        return self._tabla.dias[self._i]
 
     def to_dict(self) -> dict:
         return {
@@ -117,21 +487,6 @@ class Compra:
         }
 
 
-def _fila_to_compra(i: int, row: list) -> Compra:
-    return Compra(
-        fila=i + 1,
-        id=row[0] if row else "",
-        fecha_compra=row[1] if len(row) > 1 else "",
-        producto=row[2] if len(row) > 2 else "",
-        precio_compra=row[3] if len(row) > 3 else "0",
-        fecha_devolucion=row[4] if len(row) > 4 else "",
-        fecha_venta=row[5] if len(row) > 5 else "",
-        precio_venta=row[6] if len(row) > 6 else "",
-        metodo_pago=row[7] if len(row) > 7 else "",
-        estado=row[8] if len(row) > 8 and row[8] else "pendiente",
-    )
-
-
 # ============================================
 # TECLADOS
 # ============================================
@@ -225,195 +580,1091 @@ async def reply(update: Update, texto: str, **kwargs) -> None:
 # GOOGLE SHEETS - SERVICIO Y CACHÉ
 # ============================================
 
-# ✅ MEJORA: Singleton del service para evitar recrear la conexión OAuth en cada llamada
+# ✅ MEJORA: Cliente de Sheets consciente de la cuota. Cada petición pasa por un token
+# bucket (uno para lecturas y otro para escrituras, como las cuotas por minuto de
+# Google) y los 429/5xx se reintentan con backoff exponencial y jitter. Las tareas en
+# segundo plano dejan una reserva de tokens para que las del usuario no esperen.
+PRIORIDAD_USUARIO = 0
+PRIORIDAD_FONDO = 1
+RESERVA_USUARIO = 0.2  # fracción del bucket que el trabajo de fondo no puede gastar
+SHEETS_MAX_REINTENTOS = 5
+BACKOFF_BASE = 1.0  # segundos
+BACKOFF_MAX = 32.0
+
+_ESTADOS_REINTENTABLES = {429, 500, 502, 503, 504}
+# Fallos de red sin respuesta HTTP: conexión cortada o agotada, TLS roto a medias, o los
+# de httplib2 (p. ej. ServerNotFoundError cuando el DNS falla un momento)
+_ERRORES_RED = (ConnectionError, TimeoutError, ssl.SSLError, httplib2.HttpLib2Error)
+# Repetirlas da el mismo resultado; append y los borrados (spreadsheets.batchUpdate)
+# solo se reintentan ante un 429, que garantiza que Google no llegó a aplicarlas.
+_METODOS_IDEMPOTENTES = {
+    "sheets.spreadsheets.get",
+    "sheets.spreadsheets.values.get",
+    "sheets.spreadsheets.values.batchGet",
+    "sheets.spreadsheets.values.update",
+    "sheets.spreadsheets.values.batchUpdate",
+}
+
+_prioridad_hilo = threading.local()  # prioridad de la tarea que ejecuta cada worker
+
+
+def _en_fondo() -> bool:
+    return getattr(_prioridad_hilo, "valor", PRIORIDAD_USUARIO) == PRIORIDAD_FONDO
+
+_metricas_sheets: dict[str, float] = {
+    "peticiones": 0, "esperas_cuota": 0, "segundos_espera": 0.0,
+    "limitadas_429": 0, "reintentos": 0, "fallidas": 0,
+}
+_metricas_lock = threading.Lock()
+
+
+def _contar(clave: str, cantidad: float = 1) -> None:
+    with _metricas_lock:
+        _metricas_sheets[clave] += cantidad
+
+
+class _CubetaTokens:
+    """Token bucket: `capacidad` peticiones de golpe, recargando `por_segundo`."""
+
+    def __init__(self, capacidad: int, por_segundo: float) -> None:
+        self.capacidad = capacidad
+        self.por_segundo = por_segundo
+        self.tokens = float(capacidad)
+        self.ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def adquirir(self, reserva: float = 0.0) -> float:
+        """Espera a que quede un token por encima de `reserva`. Devuelve los segundos esperados."""
+        esperado = 0.0
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ts) * self.por_segundo)
+                self.ts = ahora
+                if self.tokens >= 1 + reserva:
+                    self.tokens -= 1
+                    return esperado
+                falta = (1 + reserva - self.tokens) / self.por_segundo
+            time.sleep(falta)
+            esperado += falta
+
+
+_cubetas = {
+    "lectura": _CubetaTokens(SHEETS_CUOTA_MINUTO, SHEETS_CUOTA_MINUTO / 60),
+    "escritura": _CubetaTokens(SHEETS_CUOTA_MINUTO, SHEETS_CUOTA_MINUTO / 60),
+}
+
+
+class _PeticionSheets(HttpRequest):
+    """HttpRequest con límite de cuota y reintentos; se inyecta con build(requestBuilder=...)."""
+
+    def execute(self, http=None, num_retries=0):
+        nombre = "lectura" if self.method == "GET" else "escritura"
+        cubeta = _cubetas[nombre]
+        fondo = _en_fondo()
+        reserva = cubeta.capacidad * RESERVA_USUARIO if fondo else 0.0
+        idempotente = self.methodId in _METODOS_IDEMPOTENTES
+        max_reintentos = SHEETS_MAX_REINTENTOS
+        prepagado = False
+        if fondo and getattr(_prioridad_hilo, "bajo_lock", False):
+            # Trabajo de fondo con _escritura_lock tomado (_bloqueo_escritura): ni reserva
+            # ni backoff, y el token de su escritura ya se pagó antes de tomar el lock.
+            reserva, max_reintentos = 0.0, 0
+            prepagado = _prioridad_hilo.prepagado == nombre
+            _prioridad_hilo.prepagado = None
+
+        for intento in range(max_reintentos + 1):
+            esperado = 0.0 if prepagado else cubeta.adquirir(reserva)
+            if esperado:
+                _contar("esperas_cuota")
+                _contar("segundos_espera", esperado)
+            _contar("peticiones")
+            try:
+                return super().execute(http=http, num_retries=num_retries)
+            except HttpError as e:
+                estado = e.resp.status
+                if estado == 429:
+                    _contar("limitadas_429")
+                reintentable = estado == 429 or (idempotente and estado in _ESTADOS_REINTENTABLES)
+                if not reintentable or intento == max_reintentos:
+                    _contar("fallidas")
+                    raise
+                motivo = f"HTTP {estado}"
+            except _ERRORES_RED as e:
+                if not idempotente or intento == max_reintentos:
+                    _contar("fallidas")
+                    raise
+                motivo = type(e).__name__
+
+            # Full jitter: espera aleatoria en [0, base·2^intento], con tope
+            espera = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** intento))
+            _contar("reintentos")
+            logger.warning(f"Sheets {self.methodId}: {motivo}, reintento {intento + 1} en {espera:.1f}s")
+            time.sleep(espera)
+
+
+def resumen_metricas_sheets() -> str:
+    with _metricas_lock:
+        m = dict(_metricas_sheets)
+    return (
+        f"peticiones={m['peticiones']} esperas_cuota={m['esperas_cuota']} "
+        f"({m['segundos_espera']:.1f}s) 429={m['limitadas_429']} "
+        f"reintentos={m['reintentos']} fallidas={m['fallidas']}"
+    )
+
+
+SHEETS_TIMEOUT = 30  # segundos por petición HTTP
+
+_servicio_hilo = threading.local()
+
+
+# ✅ MEJORA: Credenciales compartidas por todos los hilos (un único token OAuth)
 @lru_cache(maxsize=1)
-def get_sheets_service():
+def _credenciales_sheets():
     if not GOOGLE_CREDENTIALS_JSON:
         raise ValueError("GOOGLE_CREDENTIALS_JSON no está definida")
     info = json.loads(GOOGLE_CREDENTIALS_JSON)
-    creds = service_account.Credentials.from_service_account_info(
+    return service_account.Credentials.from_service_account_info(
         info, scopes=["https://www.googleapis.com/auth/spreadsheets"]
     )
-    return build("sheets", "v4", credentials=creds)
 
 
-# ✅ MEJORA: Caché en memoria de las filas de Sheets (TTL 30s) para evitar GETs repetidos
-_cache_sheets: dict = {"data": None, "ts": 0.0}
-CACHE_TTL = 30  # segundos
+# ✅ MEJORA: Un service por hilo, cada uno con su propio AuthorizedHttp (httplib2 con
+# keep-alive). Un único httplib2.Http compartido no es thread-safe; así cada worker
+# del pool reutiliza su conexión y varias peticiones pueden ir en paralelo.
+def get_sheets_service():
+    service = getattr(_servicio_hilo, "service", None)
+    if service is None:
+        http = AuthorizedHttp(_credenciales_sheets(), http=httplib2.Http(timeout=SHEETS_TIMEOUT))
+        service = build(
+            "sheets", "v4", http=http, requestBuilder=_PeticionSheets, cache_discovery=False
+        )
+        _servicio_hilo.service = service
+    return service
+
+
+# ✅ MEJORA: El sheetId no cambia durante la vida del proceso; se pide una sola vez
+@lru_cache(maxsize=1)
+def get_sheet_id() -> int:
+    spreadsheet = (
+        get_sheets_service().spreadsheets()
+        .get(spreadsheetId=GOOGLE_SHEETS_ID, fields="sheets.properties.sheetId")
+        .execute()
+    )
+    return spreadsheet["sheets"][0]["properties"]["sheetId"]
+
+
+# ✅ MEJORA: Caché en memoria de las filas de Sheets, respaldada por un snapshot en
+# disco. Las lecturas nunca esperan a Google salvo en el primer arranque (sin snapshot)
+# o si la sincronización en segundo plano lleva más de CACHE_MAX_STALE sin funcionar.
+_cache_sheets: dict = {
+    "data": None, "ts": 0.0, "ts_completo": 0.0,
+    "por_id": {}, "sufijos": [], "tokens": {}, "vocabulario": [],
+    "orden": ([], [], []),
+    "version": 0,  # sube con cada cambio local (write-through) de la caché
+    "descarga": 0,  # número de la última descarga completa instalada
+}
+CACHE_TTL = 30  # segundos; pasado esto se sirve la copia y se revalida en segundo plano
+CACHE_MAX_STALE = 600  # segundos; pasado esto la lectura recarga de Sheets en línea
+# Segundos entre descargas completas; entre medias solo se traen las filas nuevas. Es lo
+# que hace visibles las ediciones a mano de filas antiguas (appends, borrados e inserciones
+# los detecta ya la comprobación barata), así que se queda en minutos; con una hoja muy
+# grande se puede subir a costa de que esas ediciones tarden más en verse.
+REFRESCO_COMPLETO_CADA = int(os.getenv("REFRESCO_COMPLETO_CADA", "300"))
+
+# ✅ MEJORA: Con varios workers en el pool, la caché, sus índices, la cola de escrituras
+# se protegen con un lock reentrante. Solo se toma para leer o parchear la memoria:
+# las peticiones a Sheets (descargas, appends, envíos de la cola, borrados) van fuera,
+# así que una llamada lenta o en backoff no bloquea las lecturas de los handlers.
+_cache_lock = threading.RLock()
+# Serializa las escrituras que apuntan a filas por número (envío de la cola y borrados):
+# entre resolver la fila en la caché y que Sheets aplique la petición, ningún borrado
+# puede desplazarla. Nunca se pide con _cache_lock tomado (orden: este primero).
+_escritura_lock = threading.RLock()
+
+
+@contextmanager
+def _bloqueo_escritura():
+    """
+    Toma _escritura_lock. Desde un hilo de fondo, el token de escritura se paga antes
+    de esperar el lock y, ya dentro, sus peticiones no esperan la reserva ni reintentan
+    con backoff (un fallo lo recoge su siguiente pasada): el trabajo de fondo nunca
+    duerme con el lock que esperan los envíos y borrados del usuario.
+    """
+    if not _en_fondo():
+        with _escritura_lock:
+            yield
+        return
+    cubeta = _cubetas["escritura"]
+    cubeta.adquirir(cubeta.capacidad * RESERVA_USUARIO)
+    with _escritura_lock:
+        _prioridad_hilo.bajo_lock, _prioridad_hilo.prepagado = True, "escritura"
+        try:
+            yield
+        finally:
+            _prioridad_hilo.bajo_lock, _prioridad_hilo.prepagado = False, None
+
+
+def _con_cache(func):
+    """Ejecuta `func` con el lock de la caché tomado (se puede anidar)."""
+    @wraps(func)
+    def envoltura(*args, **kwargs):
+        with _cache_lock:
+            return func(*args, **kwargs)
+    return envoltura
+
+
+# ✅ MEJORA: Stale-while-revalidate. Pasado CACHE_TTL se devuelve la copia que hay y se
+# lanza una única revalidación en segundo plano (single-flight: si ya hay una en
+# marcha, no se lanza otra). Solo pasado CACHE_MAX_STALE se espera a Sheets en línea.
+_revalidacion: dict = {"futuro": None}
+_revalidacion_lock = threading.Lock()
+_descargas = itertools.count(1)
+
+
+def _revalidar_en_fondo() -> Future:
+    """Lanza _refrescar_incremental en el pool (prioridad baja) salvo que ya haya uno en curso."""
+    with _revalidacion_lock:
+        futuro = _revalidacion["futuro"]
+        if futuro is None or futuro.done():
+            futuro = _sheets_executor.enviar(PRIORIDAD_FONDO, _refrescar_incremental)
+            _revalidacion["futuro"] = futuro
+        return futuro
+
+
+@_con_cache
+def _get_all_rows() -> TablaCompras:
+    """Obtiene la tabla de compras desde la caché (o el snapshot local si está vacía)."""
+    if _cache_sheets["data"] is None and _cargar_desde_snapshot():
+        # Se sirve ya lo del disco; la revalidación (completa) va en segundo plano
+        _revalidar_en_fondo()
+    elif _cache_sheets["data"] is None:
+        # Las lecturas del usuario esperan a esta carga: va con su prioridad aunque la pida un job
+        prioridad = getattr(_prioridad_hilo, "valor", PRIORIDAD_USUARIO)
+        _prioridad_hilo.valor = PRIORIDAD_USUARIO
+        try:
+            _refrescar_desde_sheets()
+        finally:
+            _prioridad_hilo.valor = prioridad
+    edad = time.monotonic() - _cache_sheets["ts"]
+    # Un job nunca recarga en línea con el lock tomado: sirve la copia y revalida en fondo
+    if edad > CACHE_MAX_STALE and not _en_fondo():
+        # Con el lock tomado: las demás lecturas esperan a esta recarga en vez de repetirla
+        try:
+            _refrescar_incremental()
+        except Exception as e:
+            logger.warning(f"Sheets no responde, sirviendo datos de hace más de {CACHE_MAX_STALE}s: {e}")
+    elif edad > CACHE_TTL:
+        _revalidar_en_fondo()
+    tabla = _cache_sheets["data"]
+    tabla.actualizar_dia(_hoy())
+    return tabla
 
 
-def _get_all_rows() -> list:
-    """Obtiene todas las filas con caché de 30 segundos."""
-    now = time.monotonic()
-    if _cache_sheets["data"] is None or (now - _cache_sheets["ts"]) > CACHE_TTL:
-        service = get_sheets_service()
-        result = (
-            service.spreadsheets().values()
-            .get(spreadsheetId=GOOGLE_SHEETS_ID, range="A:I")
-            .execute()
+def _refrescar_desde_sheets() -> None:
+    """
+    Descarga A:I completo y reemplaza caché e índices. Una descarga que se cruzó con una
+    escritura local nunca se instala: tras tres intentos así, la caché sigue marcada para
+    recarga completa (o, si no había copia, se lanza RuntimeError).
+    """
+    for _ in range(3):
+        version = _cache_sheets["version"]
+        descarga = next(_descargas)
+        tabla = _descargar_tabla()
+        with _cache_lock:
+            if descarga < _cache_sheets["descarga"]:
+                return  # ya se instaló una descarga empezada después que esta
+            # Si otro worker escribió mientras se descargaba, la copia puede no incluirlo
+            if _cache_sheets["version"] != version:
+                continue
+            _cache_sheets["data"] = tabla
+            _cache_sheets["descarga"] = descarga
+            _cache_sheets["ts"] = _cache_sheets["ts_completo"] = time.monotonic()
+            _reconstruir_indices()
+            # Lo recién descargado aún no tiene las ventas/devoluciones en cola o en
+            # vuelo: se reaplican para que la lectura vea lo último escrito.
+            _reaplicar_escrituras()
+            # Las que esperaban a una copia validada (p. ej. restauradas del snapshot)
+            # ya pueden enviarse contra este índice
+            if _escrituras["pendientes"] and _escrituras["timer"] is None:
+                _programar_vaciado()
+        _guardar_snapshot()
+        return
+    with _cache_lock:
+        _cache_sheets["ts_completo"] = float("-inf")  # la próxima sincronización lo reintenta
+        vacia = _cache_sheets["data"] is None
+    logger.warning("Recarga completa descartada: la caché cambió durante cada descarga")
+    if vacia:
+        raise RuntimeError("No se pudo descargar una copia consistente de la hoja")
+
+
+# ✅ MEJORA: Lectura por bloques de LECTURA_BLOQUE filas. Cada bloque se convierte a la
+# tabla columnar en cuanto llega, así que nunca hay en memoria la respuesta JSON de la
+# hoja entera más su versión parseada: el pico depende del bloque, no del tamaño de la hoja.
+def _filas_en_hoja(titulo: Optional[str] = None) -> int:
+    """Filas de la cuadrícula de la pestaña `titulo` (None = la primera)."""
+    hojas = get_sheets_service().spreadsheets().get(
+        spreadsheetId=GOOGLE_SHEETS_ID,
+        fields="sheets.properties(title,gridProperties.rowCount)",
+    ).execute().get("sheets", [])
+    for hoja in hojas:
+        props = hoja["properties"]
+        if titulo is None or props.get("title") == titulo:
+            return props.get("gridProperties", {}).get("rowCount", 0)
+    return 0
+
+
+def _leer_por_bloques(titulo: Optional[str] = None):
+    """Genera (primera fila 1-based, filas) de A:I en ventanas de LECTURA_BLOQUE filas."""
+    total = _filas_en_hoja(titulo)
+    prefijo = f"'{titulo}'!" if titulo else ""
+    for inicio in range(1, total + 1, LECTURA_BLOQUE):
+        fin = min(total, inicio + LECTURA_BLOQUE - 1)
+        result = get_sheets_service().spreadsheets().values().get(
+            spreadsheetId=GOOGLE_SHEETS_ID, range=f"{prefijo}A{inicio}:I{fin}"
+        ).execute()
+        yield inicio, result.get("values", [])
+
+
+def _descargar_tabla(titulo: Optional[str] = None) -> TablaCompras:
+    """
+    A:I completo por ventanas. Un borrado o inserción en una ventana ya leída desplaza
+    las siguientes (se saltaría o repetiría una fila), y entonces la última fila de esa
+    ventana ya no está en su sitio: al acabar se comprueba el ID de la última fila de
+    cada ventana con un único batchGet y, si alguno no cuadra, se repite la descarga.
+    """
+    prefijo = f"'{titulo}'!" if titulo else ""
+    for _ in range(3):
+        tabla = TablaCompras()
+        finales = []  # última fila (1-based) de cada ventana con datos
+        for inicio, filas in _leer_por_bloques(titulo):
+            if not filas:
+                continue
+            # Sheets recorta las filas vacías al final de cada ventana; solo se rellenan si
+            # después hay datos, igual que en una lectura de A:I completa.
+            while len(tabla) < inicio - 1:
+                tabla.anexar([])
+            for row in filas:
+                tabla.anexar(row)
+            finales.append(len(tabla))
+        if not finales:
+            return tabla
+        result = get_sheets_service().spreadsheets().values().batchGet(
+            spreadsheetId=GOOGLE_SHEETS_ID, ranges=[f"{prefijo}A{fila}" for fila in finales]
+        ).execute()
+        celdas = [rango.get("values", [[""]]) for rango in result.get("valueRanges", [])]
+        ids = [celda[0][0] if celda and celda[0] else "" for celda in celdas]
+        if ids == [tabla.ids[fila - 1] for fila in finales]:
+            return tabla
+        logger.info("La hoja cambió de forma durante la descarga por bloques, se repite")
+    raise RuntimeError("La hoja cambió durante cada descarga por bloques")
+
+
+# ✅ MEJORA: Refresco incremental — casi todos los cambios son appends del propio bot,
+# así que normalmente basta con pedir las filas posteriores a la última conocida.
+def _refrescar_incremental() -> None:
+    """
+    Trae solo las filas añadidas al final (A{n+1}:I). Recarga la hoja entera si la
+    comprobación barata falla (la última fila conocida ya no tiene el mismo ID, es
+    decir, se borró o insertó algo por encima) o cada REFRESCO_COMPLETO_CADA, que es
+    lo que recoge ediciones de celdas en filas antiguas (la API de Sheets no da una
+    señal barata de "la hoja cambió").
+    """
+    with _cache_lock:
+        tabla = _cache_sheets["data"]
+        completo = (
+            tabla is None
+            or len(tabla) < 2
+            or time.monotonic() - _cache_sheets["ts_completo"] > REFRESCO_COMPLETO_CADA
         )
-        _cache_sheets["data"] = result.get("values", [])
-        _cache_sheets["ts"] = now
-    return _cache_sheets["data"]
+        if not completo:
+            version = _cache_sheets["version"]
+            n = len(tabla)
+    if completo:
+        _refrescar_desde_sheets()
+        return
+
+    result = get_sheets_service().spreadsheets().values().batchGet(
+        spreadsheetId=GOOGLE_SHEETS_ID,
+        ranges=[f"A{n}", f"A{n + 1}:I"],
+    ).execute()
+    control, cola = result.get("valueRanges", [{}, {}])
+    celda = control.get("values", [[""]])
+    id_control = celda[0][0] if celda and celda[0] else ""
+    if id_control != tabla.ids[n - 1]:
+        logger.info("Cambios por encima de la última fila conocida, recarga completa")
+        _refrescar_desde_sheets()
+        return
+
+    with _cache_lock:
+        if _cache_sheets["version"] != version or _cache_sheets["data"] is not tabla:
+            return  # la caché cambió durante la descarga; lo recoge la próxima pasada
+        nuevas = cola.get("values", [])
+        if nuevas:
+            _cache_anexar_filas(nuevas)
+        _cache_sheets["ts"] = time.monotonic()
+    if nuevas:
+        _guardar_snapshot()
+
+
+# ✅ MEJORA: Tras un reinicio, el primer /inv o "vendido" ya no paga el token OAuth ni la
+# carga de la caché: se hace al arrancar, en el pool de Sheets.
+def precalentar() -> None:
+    """Obtiene el token OAuth (primera petición real) y carga la caché y sus índices."""
+    inicio = time.monotonic()
+    try:
+        get_sheet_id()
+        filas = len(_get_all_rows()) - 1
+        logger.info(f"Caché precalentada: {filas} filas en {time.monotonic() - inicio:.1f}s")
+    except Exception as e:
+        logger.warning(f"Error precalentando Sheets (se cargará en la primera consulta): {e}")
+
+
+# ✅ MEJORA: Índice hash id_pedido → posición en la caché para búsquedas exactas O(1)
+def _reconstruir_indices() -> None:
+    """Recalcula los índices a partir de la tabla cacheada."""
+    tabla = _cache_sheets["data"]
+    por_id: dict[str, int] = {}
+    sufijos: list[tuple[str, int]] = []
+    tokens: dict[str, list[int]] = {}
+    orden: tuple[list, list, list] = ([], [], [])
+    for i in range(1, len(tabla)):
+        if not tabla.vacias[i]:
+            grupo, fecha_dev, _ = tabla.clave_orden(i)
+            orden[grupo].append((fecha_dev, i))
+        id_pedido = tabla.ids[i]
+        if id_pedido:
+            # Si un ID está repetido gana la primera fila, igual que el recorrido lineal
+            por_id.setdefault(id_pedido, i)
+            sufijos.append((id_pedido[::-1], i))
+        for token in _tokenizar(tabla.productos[i]):
+            tokens.setdefault(token, []).append(i)
+    sufijos.sort()
+    _cache_sheets["por_id"] = por_id
+    _cache_sheets["sufijos"] = sufijos
+    _cache_sheets["tokens"] = tokens
+    _cache_sheets["vocabulario"] = sorted(tokens)
+    for parte in orden:
+        parte.sort()
+    _cache_sheets["orden"] = orden
+
+
+# ✅ MEJORA: Orden del inventario mantenido incrementalmente. Tres particiones
+# (en stock, devueltos, vendidos) ordenadas por fecha de devolución: como los días
+# restantes son fecha - hoy, el orden no cambia al pasar de día y una venta o
+# devolución solo mueve una entrada de partición (bisect) en vez de reordenar todo.
+def _orden_insertar(clave: tuple[int, int, int]) -> None:
+    grupo, fecha_dev, i = clave
+    insort(_cache_sheets["orden"][grupo], (fecha_dev, i))
+
+
+def _orden_quitar(clave: tuple[int, int, int]) -> None:
+    grupo, fecha_dev, i = clave
+    parte = _cache_sheets["orden"][grupo]
+    k = bisect_left(parte, (fecha_dev, i))
+    if k < len(parte) and parte[k] == (fecha_dev, i):
+        del parte[k]
+
+
+def _tokenizar(texto: str) -> set[str]:
+    return set(TOKEN_RE.findall(texto.lower()))
+
+
+def _buscar_indice_por_id(id_pedido: str) -> Optional[int]:
+    """Devuelve el índice (0-based, fila = índice + 1) de `id_pedido` en la caché."""
+    _get_all_rows()
+    return _cache_sheets["por_id"].get(id_pedido)
+
+
+# ✅ MEJORA: Índice de sufijos (IDs invertidos ordenados + bisect) para "últimos 4-5 dígitos"
+def _buscar_indices_por_sufijo(sufijo: str) -> list[int]:
+    """
+    Índices de todas las filas cuyo ID termina en `sufijo`, ordenados por prioridad:
+    primero en stock (vencidos → urgentes → más días), luego devueltos y vendidos.
+    """
+    tabla = _get_all_rows()
+    sufijos = _cache_sheets["sufijos"]
+    invertido = sufijo[::-1]
+    indices = []
+    k = bisect_left(sufijos, (invertido,))
+    while k < len(sufijos) and sufijos[k][0].startswith(invertido):
+        indices.append(sufijos[k][1])
+        k += 1
+
+    indices.sort(key=tabla.prioridad)
+    return indices
+
+
+# ✅ MEJORA: Índice invertido de palabras del producto para /bus (sin recorrer ni
+# pasar a minúsculas todas las filas en cada búsqueda)
+def _buscar_indices_por_producto(termino: str) -> list[int]:
+    """
+    Índices (orden de la hoja) de las filas cuyo producto contiene TODAS las palabras
+    del término. Cada palabra casa en cualquier posición de una palabra del producto
+    ("auri" → "auriculares", "pod" → "AirPods" y "Podadora"), como la búsqueda original.
+    """
+    _get_all_rows()
+    tokens = _cache_sheets["tokens"]
+    vocabulario = _cache_sheets["vocabulario"]
+    palabras = _tokenizar(termino)
+    if not palabras:
+        return []
+
+    conjuntos: list[set[int]] = []
+    for palabra in palabras:
+        # Se recorre el vocabulario (palabras distintas), no las filas: son muchas menos
+        coincidentes = [t for t in vocabulario if palabra in t]
+        if not coincidentes:
+            return []
+        filas: set[int] = set()
+        for t in coincidentes:
+            filas.update(tokens[t])
+        conjuntos.append(filas)
+
+    conjuntos.sort(key=len)
+    resultado = conjuntos[0].intersection(*conjuntos[1:])
+    return sorted(resultado)
 
 
 def _invalidar_cache() -> None:
-    """Invalida la caché tras cualquier escritura."""
+    """Descarta la caché; la próxima lectura vuelve a descargar la hoja."""
     _cache_sheets["data"] = None
+    _cache_sheets["version"] += 1
+    # El snapshot refleja la caché, así que tampoco es fiable ya
+    _borrar_snapshot()
 
 
-# ✅ MEJORA: Función centralizada para parsear precios (antes duplicada en varios sitios)
-def parse_precio(valor: str) -> float:
-    if not valor:
-        return 0.0
-    limpio = valor.replace("US$", "").replace("$", "").replace(",", "").strip()
+# ✅ MEJORA: Caché write-through — las escrituras exitosas parchean las filas en memoria
+# en vez de invalidar; el TTL solo tiene que detectar ediciones hechas fuera del bot.
+_RANGO_APPEND_RE = re.compile(r"![A-Z]+(\d+)(?::[A-Z]+(\d+))?$")
+
+
+def _cache_agregar_filas(filas: list[list], respuesta: dict) -> None:
+    """Añade al final de la caché las filas recién insertadas con values().append."""
+    tabla = _cache_sheets["data"]
+    if tabla is None:
+        return
+    # El append de Sheets indica dónde quedaron las filas; si no coincide con lo que
+    # tenemos en memoria (hueco, edición externa...) la caché ya no es fiable.
+    m = _RANGO_APPEND_RE.search(respuesta.get("updates", {}).get("updatedRange", ""))
+    primera = int(m.group(1)) if m else 0
+    if primera == len(tabla) + 1:
+        _cache_anexar_filas(filas)
+        return
+    # El append va sin lock: la revalidación de fondo pudo traer ya estas mismas filas
+    ya_estan = 0 < primera and primera - 1 + len(filas) <= len(tabla) and all(
+        tabla.ids[primera - 1 + k] == f[0] for k, f in enumerate(filas)
+    )
+    if not ya_estan:
+        _invalidar_cache()
+
+
+def _cache_anexar_filas(filas: list[list]) -> None:
+    """Añade filas al final de la caché y sus índices."""
+    tabla = _cache_sheets["data"]
+    por_id = _cache_sheets["por_id"]
+    tokens = _cache_sheets["tokens"]
+    _cache_sheets["version"] += 1
+    for f in filas:
+        i = len(tabla)
+        tabla.anexar(f)
+        id_pedido = tabla.ids[i]
+        if id_pedido:
+            por_id.setdefault(id_pedido, i)
+            insort(_cache_sheets["sufijos"], (id_pedido[::-1], i))
+        for token in _tokenizar(tabla.productos[i]):
+            if token not in tokens:
+                tokens[token] = []
+                insort(_cache_sheets["vocabulario"], token)
+            tokens[token].append(i)
+        if i > 0 and not tabla.vacias[i]:
+            _orden_insertar(tabla.clave_orden(i))
+
+
+def _cache_actualizar_fila(fila: int, col_inicio: int, valores: list) -> None:
+    """Sobrescribe en memoria las celdas de `fila` (1-based) desde la columna `col_inicio` (0-based)."""
+    tabla = _cache_sheets["data"]
+    if tabla is None:
+        return
+    if fila - 1 >= len(tabla):
+        _invalidar_cache()
+        return
+    i = fila - 1
+    _cache_sheets["version"] += 1
+    antes = None if tabla.vacias[i] or i == 0 else tabla.clave_orden(i)
+    tabla.actualizar(i, col_inicio, valores)
+    if i > 0:
+        despues = tabla.clave_orden(i)
+        if despues != antes:
+            if antes is not None:
+                _orden_quitar(antes)
+            _orden_insertar(despues)
+
+
+def _cache_eliminar_filas(filas: list[int]) -> None:
+    """Quita las filas de la caché; las posteriores suben de posición igual que en Sheets."""
+    tabla = _cache_sheets["data"]
+    if tabla is None:
+        return
+    if max(filas) - 1 >= len(tabla):
+        _invalidar_cache()
+        return
+    # Tabla nueva en vez de borrar en sitio: las vistas Compra ya entregadas a los
+    # handlers siguen apuntando a la fila que eran.
+    _cache_sheets["data"] = tabla.sin_filas({fila - 1 for fila in filas})
+    _cache_sheets["version"] += 1
+    _reconstruir_indices()
+
+
+# ============================================
+# SNAPSHOT COMPRIMIDO DE LA CACHÉ
+# ============================================
+
+# ✅ MEJORA: Tras cada sincronización (y al apagar) se vuelca a disco la tabla columnar
+# ya parseada, comprimida: cabecera JSON con los textos y las columnas numéricas como
+# bytes de los array (sin pickle: cargar el archivo nunca ejecuta código). Al arrancar se
+# carga tal cual — sin parsear fila a fila —, se reconstruyen los índices y se sirve
+# mientras una revalidación completa en segundo plano la pone al día.
+SNAPSHOT_FORMATO = 3  # subir si cambia TablaCompras
+
+
+def _guardar_snapshot() -> None:
+    if not SNAPSHOT_PATH:
+        return
     try:
-        return float(limpio)
-    except ValueError:
-        return 0.0
+        with _cache_lock:
+            tabla = _cache_sheets["data"]
+            if tabla is None:
+                return
+            # epoch de la última sincronización con Sheets ("ts" es monotónico)
+            sincronizado = time.time() - (time.monotonic() - _cache_sheets["ts"])
+            cabecera, binario = tabla.volcar()
+            # La tabla ya lleva aplicadas las escrituras sin enviar: van con ella para
+            # que el próximo arranque las reenvíe en vez de darlas por guardadas
+            escrituras = {**_escrituras["en_vuelo"], **_escrituras["pendientes"]}
+        # Codificar y comprimir fuera del lock: solo se ha copiado
+        cabecera = json.dumps({
+            "formato": SNAPSHOT_FORMATO, "sincronizado": sincronizado, "tabla": cabecera,
+            "escrituras": escrituras,
+        }, ensure_ascii=False).encode("utf-8")
+        # Temporal por hilo: dos workers pueden volcar a la vez; gana el último os.replace
+        temporal = f"{SNAPSHOT_PATH}.{threading.get_ident()}.tmp"
+        with open(temporal, "wb") as f:
+            f.write(zlib.compress(len(cabecera).to_bytes(4, "big") + cabecera + binario, 1))
+        os.replace(temporal, SNAPSHOT_PATH)
+    except Exception as e:
+        logger.warning(f"Snapshot: error guardando: {e}")
 
 
-def agregar_compra(datos: dict) -> bool:
+def _cargar_desde_snapshot() -> bool:
+    """Rellena caché e índices desde el snapshot si existe y es de este formato. True si lo hizo."""
+    if not SNAPSHOT_PATH:
+        return False
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            contenido = zlib.decompress(f.read())
+        tam = int.from_bytes(contenido[:4], "big")
+        snapshot = json.loads(contenido[4:4 + tam])
+        if snapshot.get("formato") != SNAPSHOT_FORMATO:
+            return False
+        tabla = TablaCompras.restaurar(snapshot["tabla"], contenido[4 + tam:])
+    except FileNotFoundError:
+        return False
+    except Exception as e:
+        logger.warning(f"Snapshot: error cargando: {e}")
+        return False
+    _cache_sheets["data"] = tabla
+    _reconstruir_indices()
+    escrituras = snapshot.get("escrituras") or {}
+    if escrituras:
+        # Quedan en cola sin programar el envío: se mandan cuando una recarga completa
+        # instale la hoja real (las filas del snapshot aún no están comprobadas)
+        logger.warning(f"Snapshot: {len(escrituras)} escrituras sin enviar, se reenvían tras validar la hoja")
+        for id_pedido, valores in escrituras.items():
+            _escrituras["pendientes"].setdefault(id_pedido, valores)
+    # Quien lo carga lanza la revalidación en fondo: hasta entonces cuenta como reciente
+    _cache_sheets["ts"] = time.monotonic()
+    _cache_sheets["ts_completo"] = float("-inf")  # la próxima sincronización es completa
+    logger.info(
+        f"Snapshot cargado: {len(tabla) - 1} filas de hace {time.time() - snapshot['sincronizado']:.0f}s"
+    )
+    return True
+
+
+def _borrar_snapshot() -> None:
+    if not SNAPSHOT_PATH:
+        return
     try:
-        service = get_sheets_service()
-        if not datos.get("fecha_devolucion") or datos["fecha_devolucion"] == "NO_ENCONTRADO":
+        os.remove(SNAPSHOT_PATH)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Snapshot: error borrando: {e}")
+
+
+# ✅ MEJORA: Las funciones de Sheets son síncronas; los handlers async las ejecutan en
+# este pool para que una llamada lenta a Google no congele el event loop (otros botones,
+# job queue...). Cada worker tiene su propio service/conexión (get_sheets_service) y la
+# caché va protegida por _cache_lock, así que pueden ir varias peticiones a la vez.
+# La cola es de prioridad: lo que pide el usuario adelanta a refrescos y jobs de fondo.
+class _EjecutorSheets:
+    """Pool mínimo tipo ThreadPoolExecutor con cola de prioridad (FIFO dentro de cada nivel)."""
+
+    _CIERRE = 99  # detrás de cualquier tarea pendiente
+
+    def __init__(self, max_workers: int, thread_name_prefix: str) -> None:
+        self._cola: queue.PriorityQueue = queue.PriorityQueue()
+        self._secuencia = itertools.count()
+        self._cerrado = False
+        self._hilos = [
+            threading.Thread(target=self._trabajar, name=f"{thread_name_prefix}_{k}", daemon=True)
+            for k in range(max_workers)
+        ]
+        for hilo in self._hilos:
+            hilo.start()
+
+    def enviar(self, prioridad: int, fn, *args, **kwargs) -> Future:
+        if self._cerrado:
+            raise RuntimeError("El pool de Sheets ya está cerrado")
+        futuro: Future = Future()
+        self._cola.put((prioridad, next(self._secuencia), futuro, partial(fn, *args, **kwargs)))
+        return futuro
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        return self.enviar(PRIORIDAD_USUARIO, fn, *args, **kwargs)
+
+    def _trabajar(self) -> None:
+        while True:
+            prioridad, _, futuro, tarea = self._cola.get()
+            if tarea is None:
+                return
+            if not futuro.set_running_or_notify_cancel():
+                continue
+            _prioridad_hilo.valor = prioridad
             try:
-                fecha_compra = datetime.strptime(datos["fecha_compra"], "%d/%m/%Y")
-                datos["fecha_devolucion"] = (fecha_compra + timedelta(days=30)).strftime("%d/%m/%Y")
-            except Exception:
-                datos["fecha_devolucion"] = "NO_ENCONTRADO"
-
-        values = [[
-            datos.get("id_pedido", "NO_ENCONTRADO"),
-            datos.get("fecha_compra", "NO_ENCONTRADO"),
-            datos.get("producto", "NO_ENCONTRADO"),
-            datos.get("precio_compra", "0"),
-            datos.get("fecha_devolucion", "NO_ENCONTRADO"),
-            "", "", "", "pendiente",
-        ]]
-        service.spreadsheets().values().append(
+                futuro.set_result(tarea())
+            except BaseException as e:
+                futuro.set_exception(e)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._cerrado = True
+        for _ in self._hilos:
+            self._cola.put((self._CIERRE, next(self._secuencia), None, None))
+        if wait:
+            for hilo in self._hilos:
+                hilo.join()
+
+
+_sheets_executor = _EjecutorSheets(max_workers=SHEETS_WORKERS, thread_name_prefix="sheets")
+
+
+async def en_hilo_sheets(func, *args, **kwargs):
+    """Ejecuta `func(*args, **kwargs)` en el pool de Sheets sin bloquear el event loop."""
+    return await asyncio.wrap_future(_sheets_executor.submit(func, *args, **kwargs))
+
+
+async def en_fondo_sheets(func, *args, **kwargs):
+    """Como en_hilo_sheets, pero con prioridad baja (jobs y refrescos en segundo plano)."""
+    return await asyncio.wrap_future(_sheets_executor.enviar(PRIORIDAD_FONDO, func, *args, **kwargs))
+
+
+def _prioridad_estado(estado: int, dias: int) -> tuple[int, int]:
+    """Clave de orden: en stock por días (negativos = vencidos, van primero) → devueltos → vendidos."""
+    if estado == ESTADO_DEVUELTO:
+        return (1, dias)
+    if estado == ESTADO_VENDIDO:
+        return (2, dias)
+    return (0, dias)
+
+
+# ✅ MEJORA: Cola write-behind para ventas y devoluciones. Las actualizaciones de F:I
+# se aplican al instante sobre la caché y se envían agrupadas en un solo
+# values.batchUpdate tras una ventana corta o al juntar ESCRITURAS_MAX_LOTE.
+ESCRITURAS_VENTANA = 3.0  # segundos
+ESCRITURAS_MAX_LOTE = 25
+ESCRITURAS_MAX_INTENTOS = 5  # envíos fallidos (transitorios) antes de dar una escritura por perdida
+
+# id_pedido → valores F:I; una segunda escritura sobre el mismo pedido pisa a la anterior.
+# Se indexa por ID (no por fila) porque las filas se mueven si se borra alguna antes del envío.
+# "en_vuelo" es el lote que se está enviando: una descarga completa que se cruce con el
+# envío puede no traerlo todavía, así que también se reaplica.
+_escrituras: dict = {"pendientes": {}, "en_vuelo": {}, "intentos": {}, "timer": None}
+
+# Bot y event loop de la aplicación (se fijan en post_init) para avisar desde el pool
+_aviso: dict = {"bot": None, "loop": None}
+
+
+def _avisar_admin(texto: str) -> None:
+    """Manda `texto` a TU_CHAT_ID desde cualquier hilo, sin esperar a que se entregue."""
+    bot, loop = _aviso["bot"], _aviso["loop"]
+    if bot is None or loop is None or loop.is_closed():
+        return
+    futuro = asyncio.run_coroutine_threadsafe(bot.send_message(chat_id=TU_CHAT_ID, text=texto), loop)
+    futuro.add_done_callback(
+        lambda f: f.exception() and logger.error(f"Error avisando al admin: {f.exception()}")
+    )
+
+
+def _error_transitorio(e: Exception) -> bool:
+    """429/5xx o fallo de red: tiene sentido volver a intentarlo más tarde."""
+    if isinstance(e, HttpError):
+        return e.resp.status in _ESTADOS_REINTENTABLES
+    return isinstance(e, (OSError, *_ERRORES_RED))
+
+
+def _encolar_actualizacion(id_pedido: str, fila: int, valores: list) -> None:
+    """Aplica `valores` (columnas F:I) en la caché y deja la escritura en cola."""
+    _cache_actualizar_fila(fila, 5, valores)
+    _escrituras["pendientes"][id_pedido] = valores
+    if len(_escrituras["pendientes"]) >= ESCRITURAS_MAX_LOTE:
+        # Se llama con _cache_lock tomado: el envío va al pool, no aquí
+        _sheets_executor.submit(vaciar_escrituras)
+    elif _escrituras["timer"] is None:
+        _programar_vaciado()
+
+
+def _programar_vaciado(espera: float = ESCRITURAS_VENTANA) -> None:
+    # El timer solo encola el vaciado en el pool de Sheets; la cola y la caché las
+    # protege _cache_lock, gane el worker que gane.
+    timer = threading.Timer(espera, _sheets_executor.submit, args=(vaciar_escrituras,))
+    timer.daemon = True
+    _escrituras["timer"] = timer
+    timer.start()
+
+
+def _reaplicar_escrituras() -> None:
+    """Vuelve a aplicar sobre la caché las escrituras en vuelo y en cola (con _cache_lock)."""
+    for lote in (_escrituras["en_vuelo"], _escrituras["pendientes"]):
+        for id_pedido, valores in lote.items():
+            i = _cache_sheets["por_id"].get(id_pedido)
+            if i is not None:
+                _cache_actualizar_fila(i + 1, 5, valores)
+
+
+def vaciar_escrituras() -> bool:
+    """
+    Envía ya todas las escrituras en cola. Devuelve False si Sheets falló: ante un error
+    transitorio vuelven a la cola (hasta ESCRITURAS_MAX_INTENTOS envíos); uno permanente
+    (rango inválido, pestaña borrada...) no se reintenta, se descartan y se avisa.
+    """
+    with _cache_lock:
+        if not _escrituras["pendientes"]:
+            return True
+    with _bloqueo_escritura():
+        # Las filas se resuelven con por_id: si la caché viene del snapshot (o se marcó
+        # dudosa) aún no se ha comparado con la hoja y sus números de fila pueden ser de
+        # otro pedido. Antes de escribir F:I se recarga entera; la recarga reaplica la cola.
+        with _cache_lock:
+            validar = _cache_sheets["data"] is None or _cache_sheets["ts_completo"] == float("-inf")
+        if validar:
+            try:
+                _refrescar_desde_sheets()
+            except Exception as e:
+                logger.error(f"Error recargando la hoja antes de vaciar escrituras: {e}")
+        with _cache_lock:
+            timer = _escrituras["timer"]
+            if timer is not None:
+                timer.cancel()
+                _escrituras["timer"] = None
+
+            pendientes = _escrituras["pendientes"]
+            if not pendientes:
+                return True
+            if _cache_sheets["data"] is None or _cache_sheets["ts_completo"] == float("-inf"):
+                # Sin una copia validada no se escribe por número de fila: se reintenta luego
+                _programar_vaciado(ESCRITURAS_VENTANA * 2)
+                return False
+
+            lote = dict(pendientes)
+            pendientes.clear()
+            data = []
+            for id_pedido, valores in lote.items():
+                i = _cache_sheets["por_id"].get(id_pedido)
+                if i is None:
+                    logger.warning(f"Escritura descartada, {id_pedido} ya no está en la hoja")
+                    _escrituras["intentos"].pop(id_pedido, None)
+                    continue
+                fila = i + 1
+                _cache_actualizar_fila(fila, 5, valores)
+                data.append({"range": f"F{fila}:I{fila}", "values": [valores]})
+            if not data:
+                return True
+            _escrituras["en_vuelo"] = lote
+
+        try:
+            get_sheets_service().spreadsheets().values().batchUpdate(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                body={"valueInputOption": "USER_ENTERED", "data": data},
+            ).execute()
+            with _cache_lock:
+                for id_pedido in lote:
+                    _escrituras["intentos"].pop(id_pedido, None)
+            return True
+        except Exception as e:
+            logger.error(f"Error vaciar escrituras ({len(data)} filas): {e}")
+            transitorio = _error_transitorio(e)
+            perdidas = []
+            with _cache_lock:
+                intentos = _escrituras["intentos"]
+                for id_pedido, valores in lote.items():
+                    intentos[id_pedido] = intentos.get(id_pedido, 0) + 1
+                    if transitorio and intentos[id_pedido] < ESCRITURAS_MAX_INTENTOS:
+                        pendientes.setdefault(id_pedido, valores)  # si hay otra más nueva, gana esa
+                    else:
+                        intentos.pop(id_pedido)
+                        perdidas.append(id_pedido)
+                if pendientes and _escrituras["timer"] is None:
+                    _programar_vaciado(ESCRITURAS_VENTANA * 2 ** max(intentos.values(), default=0))
+                if perdidas:
+                    # La caché las da por hechas: la próxima revalidación recarga todo de Sheets
+                    _cache_sheets["ts_completo"] = float("-inf")
+            if perdidas:
+                logger.error(f"Escrituras descartadas tras fallar en Sheets: {perdidas}")
+                _revalidar_en_fondo()
+                _avisar_admin(
+                    f"⚠️ No se pudieron guardar en Sheets {len(perdidas)} venta(s)/devolución(es) "
+                    f"y se descartaron: {', '.join(perdidas)}\nError: {str(e)[:200]}"
+                )
+            return False
+        finally:
+            with _cache_lock:
+                _escrituras["en_vuelo"] = {}
+                # Una descarga que se cruzó con el envío puede no incluirlo: que se repita
+                _cache_sheets["version"] += 1
+
+
+def _fila_nueva_compra(datos: dict) -> list:
+    if not datos.get("fecha_devolucion") or datos["fecha_devolucion"] == "NO_ENCONTRADO":
+        try:
+            fecha_compra = datetime.strptime(datos["fecha_compra"], "%d/%m/%Y")
+            datos["fecha_devolucion"] = (fecha_compra + timedelta(days=30)).strftime("%d/%m/%Y")
+        except Exception:
+            datos["fecha_devolucion"] = "NO_ENCONTRADO"
+
+    return [
+        datos.get("id_pedido", "NO_ENCONTRADO"),
+        datos.get("fecha_compra", "NO_ENCONTRADO"),
+        datos.get("producto", "NO_ENCONTRADO"),
+        datos.get("precio_compra", "0"),
+        datos.get("fecha_devolucion", "NO_ENCONTRADO"),
+        "", "", "", "pendiente",
+    ]
+
+
+def _tiene_id_pedido(datos: dict) -> bool:
+    return bool(datos.get("id_pedido")) and datos["id_pedido"] != "NO_ENCONTRADO"
+
+
+# ✅ MEJORA: Todas las compras de una captura en un único values().append
+def agregar_compras(lista: list[dict]) -> list[bool]:
+    """
+    Registra varias compras con una sola petición. Devuelve un resultado por compra,
+    en el mismo orden: False si no tiene ID de pedido o si falló la escritura.
+    """
+    resultados = [_tiene_id_pedido(d) for d in lista]
+    validas = [d for d, ok in zip(lista, resultados) if ok]
+    if not validas:
+        return resultados
+
+    try:
+        values = [_fila_nueva_compra(d) for d in validas]
+        respuesta = get_sheets_service().spreadsheets().values().append(
             spreadsheetId=GOOGLE_SHEETS_ID,
             range="A:I",
             valueInputOption="USER_ENTERED",
             body={"values": values},
         ).execute()
-        _invalidar_cache()
-        return True
+        with _cache_lock:
+            _cache_agregar_filas(values, respuesta)
+        return resultados
     except Exception as e:
-        logger.error(f"Error agregar compra: {e}")
-        return False
+        logger.error(f"Error agregar compras ({len(validas)} filas): {e}")
+        return [False] * len(lista)
 
 
-def buscar_compra_por_id(id_o_sufijo: str, max_matches: int = 5) -> Optional[Compra | list[Compra]]:
-    try:
-        rows = _get_all_rows()
-        matches: list[Compra] = []
-        completo = bool(ID_COMPLETO_RE.match(id_o_sufijo))
+def agregar_compra(datos: dict) -> bool:
+    return agregar_compras([datos])[0]
 
-        for i, row in enumerate(rows[1:], 1):
-            if not row:
-                continue
-            id_pedido = row[0]
-            if completo:
-                if id_pedido == id_o_sufijo:
-                    return _fila_to_compra(i, row)
-            else:
-                if id_pedido.endswith(id_o_sufijo):
-                    matches.append(_fila_to_compra(i, row))
-                    if len(matches) >= max_matches:
-                        break
 
-        return matches if not completo else None
+@_con_cache
+def buscar_compra_por_id(
+    id_o_sufijo: str, max_matches: Optional[int] = None
+) -> Optional[Compra | list[Compra]]:
+    """ID completo → Compra o None. Sufijo → todas las coincidencias ordenadas por prioridad."""
+    try:
+        if ID_COMPLETO_RE.match(id_o_sufijo):
+            return buscar_compra_por_id_exacto(id_o_sufijo)
+
+        tabla = _get_all_rows()
+        indices = _buscar_indices_por_sufijo(id_o_sufijo)[:max_matches]
+        return [Compra(tabla, i) for i in indices]
     except Exception as e:
         logger.error(f"Error buscar compra: {e}")
         return None
 
 
+@_con_cache
 def buscar_compra_por_id_exacto(id_pedido: str) -> Optional[Compra]:
     try:
-        rows = _get_all_rows()
-        for i, row in enumerate(rows[1:], 1):
-            if row and row[0] == id_pedido:
-                return _fila_to_compra(i, row)
-        return None
+        i = _buscar_indice_por_id(id_pedido)
+        if i is None:
+            return None
+        return Compra(_cache_sheets["data"], i)
     except Exception as e:
         logger.error(f"Error buscar compra exacta: {e}")
         return None
 
 
+@_con_cache
 def registrar_venta_completa(
     id_pedido: str, fecha_venta: str, precio_venta: float, metodo_pago: str
 ) -> tuple[bool, float]:
     try:
-        service = get_sheets_service()
-        rows = _get_all_rows()
-
-        for i, row in enumerate(rows[1:], 1):
-            if row and row[0] == id_pedido:
-                fila = i + 1
-                service.spreadsheets().values().update(
-                    spreadsheetId=GOOGLE_SHEETS_ID,
-                    range=f"F{fila}:I{fila}",
-                    valueInputOption="USER_ENTERED",
-                    body={"values": [[fecha_venta, str(precio_venta), metodo_pago, "vendido"]]},
-                ).execute()
-                precio_compra = parse_precio(row[3] if len(row) > 3 else "")
-                _invalidar_cache()
-                return True, precio_compra
-
-        return False, 0.0
+        i = _buscar_indice_por_id(id_pedido)
+        if i is None:
+            return False, 0.0
+
+        # Desde el texto de la celda: un precio con formato ("$1,299.99") está en crudos
+        precio_compra = parse_precio(_cache_sheets["data"].celda(i, COL_PRECIO_COMPRA))
+        _encolar_actualizacion(id_pedido, i + 1, [fecha_venta, str(precio_venta), metodo_pago, "vendido"])
+        return True, precio_compra
     except Exception as e:
         logger.error(f"Error registrar venta: {e}")
         return False, 0.0
 
 
+@_con_cache
 def marcar_como_devuelto(id_pedido: str) -> bool:
     try:
-        service = get_sheets_service()
-        rows = _get_all_rows()
+        i = _buscar_indice_por_id(id_pedido)
+        if i is None:
+            return False
 
-        for i, row in enumerate(rows[1:], 1):
-            if row and row[0] == id_pedido:
-                fila = i + 1
-                fecha_hoy = datetime.now().strftime("%d/%m/%Y")
-                service.spreadsheets().values().update(
-                    spreadsheetId=GOOGLE_SHEETS_ID,
-                    range=f"F{fila}:I{fila}",
-                    valueInputOption="USER_ENTERED",
-                    body={"values": [[fecha_hoy, "0", "", "devuelto"]]},
-                ).execute()
-                _invalidar_cache()
-                return True
-        return False
+        fecha_hoy = datetime.now().strftime("%d/%m/%Y")
+        _encolar_actualizacion(id_pedido, i + 1, [fecha_hoy, "0", "", "devuelto"])
+        return True
     except Exception as e:
         logger.error(f"Error marcar devuelto: {e}")
         return False
 
 
-def obtener_compras_pendientes() -> list[dict]:
+@_con_cache
+def obtener_compras_pendientes() -> list[Compra]:
     try:
-        rows = _get_all_rows()
-        pendientes = []
-        for i, row in enumerate(rows[1:], 1):
-            if not row:
-                continue
-            estado = row[8] if len(row) > 8 else ""
-            if estado not in ("vendido", "devuelto"):
-                pendientes.append({
-                    "fila": i + 1,
-                    "id": row[0] if len(row) > 0 else "N/A",
-                    "fecha_compra": row[1] if len(row) > 1 else "N/A",
-                    "producto": row[2] if len(row) > 2 else "N/A",
-                    "precio": row[3] if len(row) > 3 else "N/A",
-                    "fecha_devolucion": row[4] if len(row) > 4 else "N/A",
-                })
-        return pendientes
+        tabla = _get_all_rows()
+        vendido_o_devuelto = (ESTADO_VENDIDO, ESTADO_DEVUELTO)
+        return [
+            Compra(tabla, i)
+            for i in range(1, len(tabla))
+            if not tabla.vacias[i] and tabla.estados[i] not in vendido_o_devuelto
+        ]
     except Exception as e:
         logger.error(f"Error obtener pendientes: {e}")
         return []
 
 
-def obtener_todo_inventario() -> list[dict]:
+@_con_cache
+def obtener_todo_inventario() -> list[Compra]:
     """
     Retorna TODOS los artículos ordenados por prioridad de devolución:
     1. En stock: vencidos primero → urgentes → más días restantes
@@ -421,106 +1672,188 @@ def obtener_todo_inventario() -> list[dict]:
     3. Vendidos (al final del todo)
     """
     try:
-        rows = _get_all_rows()
-        items = []
-        for i, row in enumerate(rows[1:], 1):
-            if not row:
-                continue
-            estado = row[8] if len(row) > 8 and row[8] else "pendiente"
-            fecha_dev_str = row[4] if len(row) > 4 else ""
-
-            # Calcular días restantes para ordenar
-            try:
-                fecha_dev = datetime.strptime(fecha_dev_str, "%d/%m/%Y")
-                dias_restantes = (fecha_dev - datetime.now()).days
-            except Exception:
-                dias_restantes = 9999  # sin fecha → va al fondo del grupo
-
-            items.append({
-                "fila": i + 1,
-                "id": row[0] if len(row) > 0 else "N/A",
-                "fecha_compra": row[1] if len(row) > 1 else "N/A",
-                "producto": row[2] if len(row) > 2 else "N/A",
-                "precio_compra": row[3] if len(row) > 3 else "N/A",
-                "precio_venta": row[6] if len(row) > 6 else "",
-                "fecha_devolucion": fecha_dev_str,
-                "metodo_pago": row[7] if len(row) > 7 else "",
-                "estado": estado,
-                "_dias": dias_restantes,
-            })
-
-        def _sort_key(item):
-            estado = item["estado"]
-            dias   = item["_dias"]
-            if estado not in ("vendido", "devuelto"):
-                return (0, dias)   # en stock: ordenar por días (negativos = vencidos, van primero)
-            if estado == "devuelto":
-                return (1, dias)   # devueltos después
-            return (2, dias)       # vendidos al final
-
-        items.sort(key=_sort_key)
-        return items
+        tabla = _get_all_rows()
+        return [Compra(tabla, i) for parte in _cache_sheets["orden"] for _, i in parte]
     except Exception as e:
         logger.error(f"Error obtener inventario: {e}")
         return []
 
 
-def obtener_productos_por_vencer(dias_limite: int = 5) -> list[dict]:
+# ✅ MEJORA: Lecturas proyectadas — solo las columnas necesarias en un values.batchGet,
+# por columnas, en vez de A:I completo. Para consultas estrechas sobre hojas grandes.
+def leer_columnas(rangos: list[str]) -> dict[str, list[str]]:
+    """
+    Lee de Sheets solo los rangos de columnas pedidos (p. ej. ["A:A", "C:E", "I:I"]).
+    Devuelve {letra: valores de la columna desde la fila 1}; Sheets recorta las celdas
+    vacías del final, así que las columnas pueden tener longitudes distintas.
+    """
+    result = get_sheets_service().spreadsheets().values().batchGet(
+        spreadsheetId=GOOGLE_SHEETS_ID,
+        ranges=rangos,
+        majorDimension="COLUMNS",
+    ).execute()
+    columnas: dict[str, list[str]] = {}
+    for rango, valores in zip(rangos, result.get("valueRanges", [])):
+        primera = ord(rango.split("!")[-1][0]) - ord("A")
+        for k, columna in enumerate(valores.get("values", [])):
+            columnas[chr(ord("A") + primera + k)] = columna
+    return columnas
+
+
+def _por_vencer_desde_sheets(dias_limite: int) -> list[dict]:
+    """Versión de obtener_productos_por_vencer leyendo solo ID, producto, precio, devolución y estado."""
+    vaciar_escrituras()
+    cols = leer_columnas(["A:A", "C:E", "I:I"])
+
+    def celda(letra: str, i: int) -> str:
+        columna = cols.get(letra, [])
+        return columna[i] if i < len(columna) else ""
+
+    hoy = _hoy()
+    por_vencer = []
+    for i in range(1, max((len(c) for c in cols.values()), default=0)):
+        if celda("I", i) in ("vendido", "devuelto"):
+            continue
+        ordinal = _fecha_a_ordinal(celda("E", i))
+        if not ordinal:
+            continue
+        dias_restantes = _dias_desde_ordinal(ordinal, hoy)
+        if dias_restantes <= dias_limite:
+            por_vencer.append({
+                "id": celda("A", i),
+                "producto": celda("C", i) or "N/A",
+                "precio": celda("D", i) or "N/A",
+                "fecha_devolucion": celda("E", i),
+                "dias_restantes": dias_restantes,
+            })
+    return por_vencer
+
+
+def obtener_productos_por_vencer(dias_limite: int = 5, desde_sheets: bool = False) -> list[dict]:
+    """
+    Artículos en stock que vencen en `dias_limite` días o menos. Por defecto sale de la
+    caché; con `desde_sheets` se consulta Sheets directamente (solo 5 columnas).
+    """
+    if desde_sheets:
+        try:
+            return _por_vencer_desde_sheets(dias_limite)
+        except Exception as e:
+            logger.warning(f"Error por vencer desde Sheets, usando copia local: {e}")
     try:
-        rows = _get_all_rows()
-        hoy = datetime.now()
+        hoy = _hoy()
+        # dias <= límite  ⇔  fecha_dev <= hoy + límite + 1; la partición "en stock" del
+        # índice de orden ya va por fecha, así que se corta en cuanto se pasa del tope
+        tope = hoy + dias_limite + 1
+        with _cache_lock:
+            tabla = _get_all_rows()
+            indices = []
+            for fecha_dev, i in _cache_sheets["orden"][0]:
+                if fecha_dev > tope:
+                    break
+                if tabla.fechas_dev[i]:
+                    indices.append(i)
         por_vencer = []
-        for row in rows[1:]:
-            if not row:
-                continue
-            estado = row[8] if len(row) > 8 else ""
-            if estado in ("vendido", "devuelto"):
-                continue
-            if len(row) > 4 and row[4]:
-                try:
-                    fecha_dev = datetime.strptime(row[4], "%d/%m/%Y")
-                    dias_restantes = (fecha_dev - hoy).days
-                    if dias_restantes <= dias_limite:
-                        por_vencer.append({
-                            "id": row[0],
-                            "producto": row[2] if len(row) > 2 else "N/A",
-                            "precio": row[3] if len(row) > 3 else "N/A",
-                            "fecha_devolucion": row[4],
-                            "dias_restantes": dias_restantes,
-                        })
-                except Exception:
-                    continue
+        for i in sorted(indices):
+            por_vencer.append({
+                "id": tabla.ids[i],
+                "producto": tabla.productos[i] or "N/A",
+                "precio": tabla.celda(i, COL_PRECIO_COMPRA) or "N/A",
+                "fecha_devolucion": tabla.celda(i, COL_FECHA_DEV),
+                "dias_restantes": _dias_desde_ordinal(tabla.fechas_dev[i], hoy),
+            })
         return por_vencer
     except Exception as e:
         logger.error(f"Error por vencer: {e}")
         return []
 
 
-def eliminar_compra_por_fila(fila: int) -> bool:
-    try:
-        service = get_sheets_service()
-        spreadsheet = service.spreadsheets().get(spreadsheetId=GOOGLE_SHEETS_ID).execute()
-        sheet_id = spreadsheet["sheets"][0]["properties"]["sheetId"]
-
-        request = {
-            "deleteDimension": {
-                "range": {
-                    "sheetId": sheet_id,
-                    "dimension": "ROWS",
-                    "startIndex": fila - 1,
-                    "endIndex": fila,
+def _resolver_filas_verificadas(ids: list[str], hasta: str = "A") -> dict[str, tuple[int, list]]:
+    """
+    Fila actual (1-based) de cada ID según el índice, comprobada contra la columna A
+    de Sheets, junto con las celdas A..`hasta` de esa fila tal como están en Sheets
+    (una sola petición). Si alguna no coincide (la hoja cambió fuera del bot) se
+    recarga la caché una vez y se vuelve a resolver; los IDs que sigan sin cuadrar
+    se omiten.
+    """
+    for intento in range(2):
+        filas = {}
+        with _cache_lock:
+            for id_pedido in ids:
+                i = _buscar_indice_por_id(id_pedido)
+                if i is not None:
+                    filas[id_pedido] = i + 1
+        if not filas:
+            return {}
+
+        result = get_sheets_service().spreadsheets().values().batchGet(
+            spreadsheetId=GOOGLE_SHEETS_ID,
+            ranges=[f"A{fila}:{hasta}{fila}" for fila in filas.values()],
+        ).execute()
+        verificadas = {}
+        for (id_pedido, fila), rango in zip(filas.items(), result.get("valueRanges", [])):
+            valores = rango.get("values", [[""]])
+            if valores and valores[0] and valores[0][0] == id_pedido:
+                verificadas[id_pedido] = (fila, valores[0])
+        if len(verificadas) == len(filas) or intento == 1:
+            return verificadas
+        _refrescar_desde_sheets()
+    return {}
+
+
+def _eliminar_filas_verificadas(verificadas: dict[str, int]) -> dict[str, int]:
+    """
+    Borra en un único batchUpdate (de abajo arriba, para no desplazar índices) las
+    filas verificadas cuyo ID sigue en esa posición de la caché. La verificación va
+    sin lock, así que otro borrado pudo mover filas entretanto: esas no se tocan.
+    Devuelve las filas borradas.
+    """
+    sheet_id = get_sheet_id()
+    with _bloqueo_escritura():
+        with _cache_lock:
+            filas = {
+                id_pedido: fila for id_pedido, fila in verificadas.items()
+                if _buscar_indice_por_id(id_pedido) == fila - 1
+            }
+        if not filas:
+            return {}
+        requests_borrado = [
+            {
+                "deleteDimension": {
+                    "range": {
+                        "sheetId": sheet_id,
+                        "dimension": "ROWS",
+                        "startIndex": fila - 1,
+                        "endIndex": fila,
+                    }
                 }
             }
-        }
-        service.spreadsheets().batchUpdate(
+            for fila in sorted(set(filas.values()), reverse=True)
+        ]
+        get_sheets_service().spreadsheets().batchUpdate(
             spreadsheetId=GOOGLE_SHEETS_ID,
-            body={"requests": [request]},
+            body={"requests": requests_borrado},
         ).execute()
-        _invalidar_cache()
-        return True
+        with _cache_lock:
+            _cache_eliminar_filas(list(set(filas.values())))
+    return filas
+
+
+# ✅ MEJORA: Borrado por ID (no por una fila guardada que puede haberse movido) y
+# varios borrados en un único batchUpdate, de abajo arriba para no desplazar índices
+def eliminar_compras_por_id(ids: list[str]) -> list[bool]:
+    """Elimina las filas de los pedidos indicados. Devuelve un resultado por ID, en orden."""
+    try:
+        vaciar_escrituras()
+        filas = {id_pedido: fila for id_pedido, (fila, _) in _resolver_filas_verificadas(ids).items()}
+        borradas = _eliminar_filas_verificadas(filas) if filas else {}
+        return [id_pedido in borradas for id_pedido in ids]
     except Exception as e:
-        logger.error(f"Error eliminar compra: {e}")
-        return False
+        logger.error(f"Error eliminar compras: {e}")
+        return [False] * len(ids)
+
+
+def eliminar_compra_por_id(id_pedido: str) -> bool:
+    return eliminar_compras_por_id([id_pedido])[0]
 
 
 def buscar_compra_por_id_para_eliminar(
@@ -530,24 +1863,244 @@ def buscar_compra_por_id_para_eliminar(
     return buscar_compra_por_id(id_o_sufijo)
 
 
+# ============================================
+# ARCHIVO DE PEDIDOS CERRADOS
+# ============================================
+
+# ✅ MEJORA: Los vendidos/devueltos antiguos se mueven a otra pestaña (ARCHIVO_HOJA) para
+# que A:I de la hoja principal — lo que se descarga, indexa y ordena — solo contenga
+# historial reciente. El archivo solo se lee bajo demanda (/arc).
+ARCHIVO_MAX_LOTE = 500  # filas por pasada del job, para no mandar batchUpdates enormes
+ARCHIVO_MAX_RESULTADOS = 20
+_archivo_lock = threading.Lock()  # que dos primeras llamadas no creen la pestaña a la vez
+
+
+def _rango_no_encontrado(e: Exception) -> bool:
+    """400 de Sheets por un rango que no existe (p. ej. la pestaña de archivo, borrada a mano)."""
+    return isinstance(e, HttpError) and e.resp.status == 400 and "Unable to parse range" in str(e)
+
+
+# Se cachea porque existe casi siempre; si Sheets responde "rango no encontrado" se
+# vacía con _rango_archivo.cache_clear() y la siguiente llamada la vuelve a crear.
+@lru_cache(maxsize=1)
+def _rango_archivo() -> str:
+    """Rango A:I de la pestaña de archivo; la crea (con la cabecera de la principal) si no existe."""
+    service = get_sheets_service()
+    with _archivo_lock:
+        hojas = service.spreadsheets().get(
+            spreadsheetId=GOOGLE_SHEETS_ID, fields="sheets.properties.title"
+        ).execute()
+        titulos = {h["properties"]["title"] for h in hojas.get("sheets", [])}
+        if ARCHIVO_HOJA not in titulos:
+            service.spreadsheets().batchUpdate(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                body={"requests": [{"addSheet": {"properties": {"title": ARCHIVO_HOJA}}}]},
+            ).execute()
+            with _cache_lock:
+                cabecera = _get_all_rows().fila(0)
+            if cabecera:
+                service.spreadsheets().values().update(
+                    spreadsheetId=GOOGLE_SHEETS_ID,
+                    range=f"'{ARCHIVO_HOJA}'!A1",
+                    valueInputOption="RAW",
+                    body={"values": [cabecera]},
+                ).execute()
+    return f"'{ARCHIVO_HOJA}'!A:I"
+
+
+def archivar_cerrados(dias: int = ARCHIVO_DIAS) -> int:
+    """
+    Mueve a la pestaña de archivo los pedidos vendidos/devueltos cuya fecha de cierre
+    (columna F) tiene más de `dias` días. Lo que se copia es la fila tal como está en
+    Sheets (leída al verificar), no la de la caché, que puede ir atrasada y tiene
+    precios y fechas normalizados. Primero copia y después borra, así que un fallo a
+    medias deja como mucho un duplicado en el archivo, nunca un pedido perdido.
+    Devuelve cuántos pedidos se archivaron.
+    """
+    vaciar_escrituras()
+    tope = _hoy() - dias
+    with _cache_lock:
+        tabla = _get_all_rows()
+        candidatos = [
+            tabla.ids[i]
+            for parte in _cache_sheets["orden"][1:]
+            for _, i in parte
+            if tabla.ids[i] and 0 < tabla.fechas_venta[i] <= tope
+        ][:ARCHIVO_MAX_LOTE]
+    if not candidatos:
+        return 0
+
+    verificadas = _resolver_filas_verificadas(candidatos, hasta="I")
+    if not verificadas:
+        return 0
+    ordenadas = sorted(verificadas.items(), key=lambda par: par[1][0])
+    for intento in range(2):
+        try:
+            get_sheets_service().spreadsheets().values().append(
+                spreadsheetId=GOOGLE_SHEETS_ID,
+                range=_rango_archivo(),
+                valueInputOption="USER_ENTERED",
+                insertDataOption="INSERT_ROWS",
+                body={"values": [row for _, (_, row) in ordenadas]},
+            ).execute()
+            break
+        except HttpError as e:
+            if intento or not _rango_no_encontrado(e):
+                raise
+            logger.warning(f"La pestaña {ARCHIVO_HOJA} ya no existe, se vuelve a crear")
+            _rango_archivo.cache_clear()
+
+    # Ya verificadas: se borran directamente, sin volver a leer la columna A
+    borradas = _eliminar_filas_verificadas({id_pedido: fila for id_pedido, (fila, _) in ordenadas})
+    if len(borradas) < len(ordenadas):
+        logger.warning(
+            f"Archivo: {len(ordenadas) - len(borradas)} pedidos copiados pero no borrados de la hoja principal"
+        )
+    return len(borradas)
+
+
+def buscar_en_archivo(termino: str) -> list[Compra]:
+    """
+    Misma búsqueda que _ejecutar_busqueda (ID, dígitos finales o palabras) sobre el
+    archivo. Se recorre por bloques y solo se guardan las coincidencias. Es solo
+    lectura: si la pestaña no existe (aún no se ha archivado nada) no hay resultados.
+    """
+    if ID_COMPLETO_RE.match(termino):
+        coincide = lambda row: row[0] == termino
+    elif termino.isdigit():
+        coincide = lambda row: row[0].endswith(termino)
+    else:
+        palabras = _tokenizar(termino)
+        if not palabras:
+            return []
+
+        def coincide(row: list) -> bool:
+            tokens = _tokenizar(row[2] if len(row) > 2 else "")
+            return all(any(p in t for t in tokens) for p in palabras)
+
+    # Las más recientes están al final: basta con quedarse con las últimas N
+    ultimas: deque = deque(maxlen=ARCHIVO_MAX_RESULTADOS)
+    try:
+        # Sin la pestaña, _filas_en_hoja da 0 y no se lee nada
+        for inicio, filas in _leer_por_bloques(ARCHIVO_HOJA):
+            for k, row in enumerate(filas):
+                if inicio + k > 1 and row and coincide(row):
+                    ultimas.append(row)
+    except HttpError as e:
+        if not _rango_no_encontrado(e):
+            raise
+        _rango_archivo.cache_clear()  # la borraron mientras se leía
+        return []
+    tabla = TablaCompras.desde_filas(list(reversed(ultimas)))
+    return [Compra(tabla, i) for i in range(len(tabla))]
+
+
+# ============================================
+# PREPROCESADO DE IMÁGENES
+# ============================================
+
+# ✅ MEJORA: las capturas son texto sobre fondo plano; a resolución completa solo
+# inflan el JSON (base64) y la latencia de Gemini. Se descarga el PhotoSize justo y,
+# si aun así se pasa del presupuesto, se reescala y recomprime en un pool aparte
+# (Pillow suelta el GIL al redimensionar/codificar, así que no frena el event loop).
+IMAGEN_CALIDADES = (85, 75, 65)
+IMAGEN_LADO_MIN = 1000
+
+_imagen_executor = ThreadPoolExecutor(max_workers=IMAGEN_WORKERS, thread_name_prefix="imagen")
+
+
+def _elegir_foto(fotos):
+    """El PhotoSize más pequeño cuyo lado mayor llega a IMAGEN_LADO_MAX (o el mayor disponible)."""
+    for foto in fotos:  # Telegram los manda de menor a mayor
+        if max(foto.width, foto.height) >= IMAGEN_LADO_MAX:
+            return foto
+    return fotos[-1]
+
+
+def _comprimir_imagen(datos: bytes) -> bytes:
+    """Reescala y recomprime a JPEG hasta quedar dentro de IMAGEN_BYTES_OBJETIVO."""
+    img = Image.open(BytesIO(datos))
+    if len(datos) <= IMAGEN_BYTES_OBJETIVO and img.format == "JPEG" and max(img.size) <= IMAGEN_LADO_MAX:
+        return datos
+
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    img.thumbnail((IMAGEN_LADO_MAX, IMAGEN_LADO_MAX), Image.LANCZOS)
+    while True:
+        for calidad in IMAGEN_CALIDADES:
+            salida = BytesIO()
+            img.save(salida, format="JPEG", quality=calidad, optimize=True)
+            if salida.tell() <= IMAGEN_BYTES_OBJETIVO:
+                return salida.getvalue()
+        lado = int(max(img.size) * 0.8)
+        if lado < IMAGEN_LADO_MIN:
+            # Por debajo de esto el texto deja de leerse bien: mejor pasarse un poco
+            return salida.getvalue()
+        img.thumbnail((lado, lado), Image.LANCZOS)
+
+
+def _cargar_imagen_base64(path: str) -> str:
+    with open(path, "rb") as f:
+        datos = f.read()
+    try:
+        datos = _comprimir_imagen(datos)
+    except Exception as e:
+        logger.warning(f"No se pudo comprimir {path}, se envía original: {e}")
+    return base64.b64encode(datos).decode("utf-8")
+
+
+async def en_hilo_imagen(func, *args):
+    return await asyncio.wrap_future(_imagen_executor.submit(func, *args))
+
+
 # ============================================
 # GEMINI
 # ============================================
 
 GEMINI_URL = (
     "https://generativelanguage.googleapis.com/v1beta/models/"
-    "gemini-2.5-flash:generateContent?key="
+    "gemini-2.5-flash:generateContent"
 )
 
 
-def _cargar_imagen_base64(path: str) -> str:
-    with open(path, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+# ✅ MEJORA: Un único cliente HTTP asíncrono para Gemini, con keep-alive (sin handshake
+# TLS en cada petición) y un semáforo que limita cuántas llamadas van a la vez. Al ser
+# async, el event loop sigue atendiendo otros handlers mientras Gemini responde.
+_gemini: dict = {"cliente": None, "semaforo": None}
+
+
+def _gemini_cliente() -> httpx.AsyncClient:
+    if _gemini["cliente"] is None:
+        _gemini["cliente"] = httpx.AsyncClient(
+            # La clave va en cabecera: httpx registra la URL de cada petición en los logs
+            headers={"Content-Type": "application/json", "x-goog-api-key": GEMINI_API_KEY or ""},
+            limits=httpx.Limits(
+                max_connections=GEMINI_CONCURRENCIA,
+                max_keepalive_connections=GEMINI_CONCURRENCIA,
+                keepalive_expiry=120,
+            ),
+        )
+        _gemini["semaforo"] = asyncio.Semaphore(GEMINI_CONCURRENCIA)
+    return _gemini["cliente"]
+
+
+async def cerrar_gemini() -> None:
+    if _gemini["cliente"] is not None:
+        await _gemini["cliente"].aclose()
+        _gemini["cliente"] = None
+
+
+async def _gemini_generar(payload: dict, timeout: float) -> str:
+    """POST a generateContent y devuelve el texto de la primera respuesta."""
+    cliente = _gemini_cliente()
+    async with _gemini["semaforo"]:
+        response = await cliente.post(GEMINI_URL, json=payload, timeout=timeout)
+    if response.status_code != 200:
+        raise Exception(f"Error Gemini: {response.status_code} - {response.text}")
+    return response.json()["candidates"][0]["content"]["parts"][0]["text"].strip()
 
 
-def extraer_datos_imagen(image_path: str, intentos: int = 2) -> dict:
-    url = GEMINI_URL + GEMINI_API_KEY
-    img_base64 = _cargar_imagen_base64(image_path)
+async def extraer_datos_imagen(image_path: str, intentos: int = 2) -> dict:
+    img_base64 = await en_hilo_imagen(_cargar_imagen_base64, image_path)
 
     prompt = """
     Analiza esta captura de pantalla de compra online.
@@ -581,16 +2134,7 @@ def extraer_datos_imagen(image_path: str, intentos: int = 2) -> dict:
     ultimo_error = None
     for intento in range(intentos):
         try:
-            response = requests.post(
-                url,
-                headers={"Content-Type": "application/json"},
-                json=payload,
-                timeout=30,
-            )
-            if response.status_code != 200:
-                raise Exception(f"Error Gemini: {response.status_code} - {response.text}")
-
-            texto = response.json()["candidates"][0]["content"]["parts"][0]["text"].strip()
+            texto = await _gemini_generar(payload, timeout=30)
             if texto.startswith("```"):
                 texto = texto.split("```", 2)[1].strip()
             if texto.startswith("json"):
@@ -620,15 +2164,13 @@ def extraer_datos_imagen(image_path: str, intentos: int = 2) -> dict:
     raise Exception(f"Fallo tras {intentos} intentos: {ultimo_error}")
 
 
-def generar_review_con_gemini_multiples_imagenes(
+async def generar_review_con_gemini_multiples_imagenes(
     image_paths: list[str],
     estrellas: int,
     uso: str,
     producto_nombre: Optional[str] = None,
 ) -> str:
-    url = GEMINI_URL + GEMINI_API_KEY
-
-    imagenes_base64 = [_cargar_imagen_base64(p) for p in image_paths]
+    imagenes_base64 = await asyncio.gather(*(en_hilo_imagen(_cargar_imagen_base64, p) for p in image_paths))
 
     uso_desc = {
         "personal": "Uso personal (Me compré..., Yo lo uso...)",
@@ -691,18 +2233,112 @@ Analiza las imágenes adjuntas del producto. Genera la reseña siguiendo el perf
     ]
 
     payload = {"contents": [{"parts": parts}]}
+    return await _gemini_generar(payload, timeout=120)
 
-    response = requests.post(
-        url,
-        headers={"Content-Type": "application/json"},
-        json=payload,
-        timeout=120,
-    )
 
-    if response.status_code != 200:
-        raise Exception(f"Error Gemini: {response.status_code} - {response.text}")
+# ============================================
+# CACHÉ DE EXTRACCIONES
+# ============================================
 
-    return response.json()["candidates"][0]["content"]["parts"][0]["text"].strip()
+# ✅ MEJORA: reenviar la misma captura (tras un fallo o desde otro chat) ya no vuelve a
+# descargarla ni a pasar por Gemini. Clave primaria: file_unique_id de Telegram; si no
+# está, se descarga y se prueba con el hash del contenido. Vive en SQLite con
+# expulsión LRU, y las peticiones idénticas que lleguen a la vez comparten una única
+# llamada en vuelo.
+_extracciones_en_vuelo: dict[str, asyncio.Future] = {}
+# Una sola conexión (con ":memory:" es la única forma de compartir la base) usada desde
+# varios workers del pool de imágenes: sqlite3 no serializa el uso concurrente de una
+# conexión, así que cada acceso, incluida su creación, va con este lock.
+_extracciones_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _cache_extracciones() -> sqlite3.Connection:
+    conn = sqlite3.connect(EXTRACCIONES_DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS extracciones (
+            clave TEXT PRIMARY KEY, datos TEXT NOT NULL, usado REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS ix_extracciones_usado ON extracciones(usado);
+    """)
+    return conn
+
+
+def _extraccion_leer(clave: str) -> Optional[str]:
+    try:
+        with _extracciones_lock:
+            conn = _cache_extracciones()
+            fila = conn.execute("SELECT datos FROM extracciones WHERE clave = ?", (clave,)).fetchone()
+            if fila:
+                conn.execute("UPDATE extracciones SET usado = ? WHERE clave = ?", (time.time(), clave))
+                return fila[0]
+    except Exception as e:
+        logger.warning(f"Caché de extracciones: error leyendo {clave}: {e}")
+    return None
+
+
+def _extraccion_guardar(clave: str, datos: str) -> None:
+    try:
+        with _extracciones_lock:
+            conn = _cache_extracciones()
+            with conn:
+                conn.execute("BEGIN")
+                conn.execute("INSERT OR REPLACE INTO extracciones VALUES (?, ?, ?)", (clave, datos, time.time()))
+                conn.execute(
+                    "DELETE FROM extracciones WHERE clave IN "
+                    "(SELECT clave FROM extracciones ORDER BY usado DESC LIMIT -1 OFFSET ?)",
+                    (EXTRACCIONES_MAX,),
+                )
+    except Exception as e:
+        logger.warning(f"Caché de extracciones: error guardando {clave}: {e}")
+
+
+def _hash_archivo(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+async def _extraccion_compartida(clave: str, producir) -> str:
+    """Devuelve el JSON cacheado para `clave` o lo obtiene con `producir()` (una sola vez en vuelo)."""
+    futuro = _extracciones_en_vuelo.get(clave)
+    if futuro is None:
+        futuro = asyncio.ensure_future(_extraccion_con_cache(clave, producir))
+        _extracciones_en_vuelo[clave] = futuro
+        futuro.add_done_callback(lambda _: _extracciones_en_vuelo.pop(clave, None))
+    # shield: si el handler que la lanzó se cancela, los demás siguen esperando el resultado
+    return await asyncio.shield(futuro)
+
+
+def _extraccion_valida(datos: str) -> bool:
+    """Solo se cachea si algún producto trae ID: una lectura fallida se reintenta al reenviar."""
+    return any(_tiene_id_pedido(prod) for prod in json.loads(datos).get("productos", []))
+
+
+async def _extraccion_con_cache(clave: str, producir) -> str:
+    datos = await en_hilo_imagen(_extraccion_leer, clave)
+    if datos is None:
+        datos = await producir()
+        if _extraccion_valida(datos):
+            await en_hilo_imagen(_extraccion_guardar, clave, datos)
+    return datos
+
+
+async def extraer_datos_foto(photo, image_path: str) -> dict:
+    """extraer_datos_imagen con caché; solo descarga la foto en `image_path` si no hay acierto."""
+
+    async def por_contenido() -> str:
+        file = await photo.get_file()
+        await file.download_to_drive(image_path)
+        clave_hash = f"sha256:{await en_hilo_imagen(_hash_archivo, image_path)}"
+        return await _extraccion_compartida(clave_hash, por_gemini)
+
+    async def por_gemini() -> str:
+        return json.dumps(await extraer_datos_imagen(image_path), ensure_ascii=False)
+
+    # Cada llamada recibe su propio dict (los handlers pueden modificarlo)
+    return json.loads(await _extraccion_compartida(f"tg:{photo.file_unique_id}", por_contenido))
 
 
 # ============================================
@@ -714,18 +2350,17 @@ def autorizado(update: Update) -> bool:
     return uid == TU_CHAT_ID
 
 
-def estado_visual(fecha_devolucion_str: str) -> str:
-    try:
-        fecha_dev = datetime.strptime(fecha_devolucion_str, "%d/%m/%Y")
-        dias = (fecha_dev - datetime.now()).days
-        if dias < 0:
-            return "🔴 VENCIDO"
-        elif dias <= 3:
-            return f"⚠️ {dias}d URGENTE"
-        else:
-            return f"✅ {dias}d"
-    except Exception:
+# ✅ MEJORA: Recibe los días ya calculados (Compra.dias o _dias_hasta) en vez de
+# volver a parsear la fecha por cada entrada que se pinta.
+def estado_visual(dias: int) -> str:
+    if dias == SIN_FECHA_DIAS:
         return "⚠️"
+    if dias < 0:
+        return "🔴 VENCIDO"
+    elif dias <= 3:
+        return f"⚠️ {dias}d URGENTE"
+    else:
+        return f"✅ {dias}d"
 
 
 # Cualquier mensaje del bot que tenga un ID de pedido es suficiente para respuesta rápida.
@@ -801,7 +2436,7 @@ async def ayuda(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "*RESPUESTAS RÁPIDAS ⚡*\n"
         "Responde 'vendido' o 'devuelto' a cualquier mensaje del bot para actualizar\n\n"
         "*INVENTARIO 📦*\n• Muestra TODOS los artículos\n• Ordenado: vencidos → urgentes → stock → devueltos → vendidos\n• Se pagina automáticamente si hay muchos items\n\n"
-        "*BUSCAR 🔍*\n• `/bus auriculares` — busca por nombre\n• `/bus 3462` — busca por dígitos del ID\n• `/bus 114-xxx-xxx` — ID completo\n\n"
+        "*BUSCAR 🔍*\n• `/bus auriculares sony` — busca por nombre (todas las palabras)\n• `/bus 3462` — busca por dígitos del ID\n• `/bus 114-xxx-xxx` — ID completo\n• `/arc 3462` — igual, en los pedidos archivados\n\n"
         "*ALERTAS 🔔*\nCada día a las 20:00 si hay productos por vencer",
         parse_mode="Markdown",
         reply_markup=get_inline_compra_venta_buttons(),
@@ -827,6 +2462,93 @@ async def iniciar_compra(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ESPERANDO_COMPRA_FOTO
 
 
+# ✅ MEJORA: un álbum (media group) llega como N updates sueltos. Se agrupan por
+# media_group_id y, cuando dejan de llegar fotos durante ALBUM_ESPERA, un job procesa
+# todas: descargas + extracciones en paralelo (acotadas), un único append a Sheets y un
+# único mensaje de resumen.
+ALBUM_MAX_DETALLE = 15
+_albumes: dict[str, dict] = {}
+
+
+def _resumen_compras(productos: list[dict], resultados: list[bool]) -> str:
+    guardados = [prod for prod, ok in zip(productos, resultados) if ok]
+    errores = len(productos) - len(guardados)
+
+    mensaje = ""
+    if guardados:
+        mensaje += f"✅ *{len(guardados)} COMPRA(S) REGISTRADA(S)*\n\n"
+        for prod in guardados[:ALBUM_MAX_DETALLE]:
+            est = estado_visual(_dias_hasta(prod.get("fecha_devolucion", "")))
+            mensaje += (
+                f"ID: {prod['id_pedido']}\n"
+                f"📦 {prod['producto']}\n"
+                f"💰 Total: ${prod['precio_compra']}\n"
+                f"⚠️ Devolución: {prod['fecha_devolucion']} ({est})\n\n"
+            )
+        if len(guardados) > ALBUM_MAX_DETALLE:
+            mensaje += f"_…y {len(guardados) - ALBUM_MAX_DETALLE} más_\n\n"
+    if errores:
+        mensaje += f"⚠️ Errores: {errores}\n"
+    return mensaje
+
+
+async def _encolar_foto_album(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    grupo = update.message.media_group_id
+    album = _albumes.get(grupo)
+    if album is None:
+        msg = await update.message.reply_text("⏳ Analizando álbum...")
+        album = _albumes[grupo] = {"fotos": [], "msg": msg, "job": None}
+    album["fotos"].append((
+        _elegir_foto(update.message.photo),
+        f"/tmp/compra_{update.message.chat_id}_{update.message.message_id}.jpg",
+    ))
+    # Cada foto nueva aplaza el procesado: así el job ve el álbum completo
+    if album["job"] is not None:
+        album["job"].schedule_removal()
+    album["job"] = context.job_queue.run_once(
+        procesar_album, ALBUM_ESPERA, data=grupo, chat_id=update.message.chat_id
+    )
+
+
+async def procesar_album(context: ContextTypes.DEFAULT_TYPE) -> None:
+    album = _albumes.pop(context.job.data, None)
+    if album is None:
+        return
+    fotos, msg = album["fotos"], album["msg"]
+    semaforo = asyncio.Semaphore(ALBUM_CONCURRENCIA)
+
+    async def extraer(photo, image_path):
+        async with semaforo:
+            return await extraer_datos_foto(photo, image_path)
+
+    try:
+        extraidos = await asyncio.gather(*(extraer(p, path) for p, path in fotos), return_exceptions=True)
+        productos, fallidas = [], 0
+        for datos in extraidos:
+            if isinstance(datos, Exception):
+                logger.error(f"Error extrayendo foto de álbum: {datos}")
+                fallidas += 1
+            else:
+                productos.extend(datos.get("productos", []))
+
+        resultados = await en_hilo_sheets(agregar_compras, productos) if productos else []
+        mensaje = f"🖼️ Álbum: {len(fotos)} foto(s)\n\n" + _resumen_compras(productos, resultados)
+        if fallidas:
+            mensaje += f"❌ Fotos sin leer: {fallidas}\n"
+        if not any(resultados):
+            mensaje += "⚠️ No se pudo registrar ninguna compra."
+
+        await msg.edit_text(mensaje, parse_mode="Markdown", reply_markup=get_inline_compra_venta_buttons())
+
+    except Exception as e:
+        logger.error(f"Error procesando álbum: {e}")
+        await msg.edit_text(f"❌ Error: {str(e)[:150]}", reply_markup=get_inline_compra_venta_buttons())
+    finally:
+        for _, image_path in fotos:
+            if os.path.exists(image_path):
+                os.remove(image_path)
+
+
 async def procesar_compra(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     if not autorizado(update):
         return ConversationHandler.END
@@ -835,40 +2557,22 @@ async def procesar_compra(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         await update.message.reply_text("❌ Envía una imagen", reply_markup=None)
         return ESPERANDO_COMPRA_FOTO
 
-    photo = update.message.photo[-1]
-    file = await photo.get_file()
+    if update.message.media_group_id:
+        # El resto del álbum llega por manejar_foto, que vuelve a entrar aquí
+        await _encolar_foto_album(update, context)
+        return ConversationHandler.END
+
+    photo = _elegir_foto(update.message.photo)
     # ✅ MEJORA: usar /tmp de forma consistente (evita problemas en Railway)
     image_path = f"/tmp/compra_{update.message.chat_id}_{update.message.message_id}.jpg"
-    await file.download_to_drive(image_path)
     msg = await update.message.reply_text("⏳ Analizando...")
 
     try:
-        datos = extraer_datos_imagen(image_path)
+        datos = await extraer_datos_foto(photo, image_path)
         productos = datos.get("productos", [])
-        guardados, errores = [], []
 
-        for prod in productos:
-            if prod.get("id_pedido") and prod["id_pedido"] != "NO_ENCONTRADO":
-                if agregar_compra(prod):
-                    guardados.append(prod)
-                else:
-                    errores.append(prod.get("producto", "Desconocido"))
-            else:
-                errores.append(prod.get("producto", "Sin ID"))
-
-        mensaje = ""
-        if guardados:
-            mensaje += f"✅ *{len(guardados)} COMPRA(S) REGISTRADA(S)*\n\n"
-            for prod in guardados:
-                est = estado_visual(prod.get("fecha_devolucion", ""))
-                mensaje += (
-                    f"ID: {prod['id_pedido']}\n"
-                    f"📦 {prod['producto']}\n"
-                    f"💰 Total: ${prod['precio_compra']}\n"
-                    f"⚠️ Devolución: {prod['fecha_devolucion']} ({est})\n\n"
-                )
-        if errores:
-            mensaje += f"⚠️ Errores: {len(errores)}\n"
+        resultados = await en_hilo_sheets(agregar_compras, productos)
+        mensaje = _resumen_compras(productos, resultados)
         if not mensaje:
             mensaje = "⚠️ No se pudo registrar ninguna compra."
 
@@ -912,7 +2616,7 @@ async def recibir_id_venta(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await manejar_mensaje_texto(update, context)
         return ConversationHandler.END
 
-    compra = buscar_compra_por_id(texto_id)
+    compra = await en_hilo_sheets(buscar_compra_por_id, texto_id)
 
     if isinstance(compra, Compra):
         if compra.estado in ("vendido", "devuelto"):
@@ -923,7 +2627,7 @@ async def recibir_id_venta(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             return ConversationHandler.END
 
         # ── Confirmación antes de proceder ───────────────────────────────────
-        est = estado_visual(compra.fecha_devolucion)
+        est = estado_visual(compra.dias)
         context.user_data["venta_id"] = compra.id
         context.user_data["compra_info"] = compra.to_dict()
         await update.message.reply_text(
@@ -946,7 +2650,7 @@ async def recibir_id_venta(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if isinstance(compra, list) and compra:
         candidato = compra[0]
         context.user_data["venta_candidato"] = candidato.to_dict()
-        est = estado_visual(candidato.fecha_devolucion)
+        est = estado_visual(candidato.dias)
         await update.message.reply_text(
             f"🔍 *¿Es este el pedido?*\n\n"
             f"┌─────────────────────────\n"
@@ -996,7 +2700,7 @@ async def confirmar_venta_por_sufijo(update: Update, context: ContextTypes.DEFAU
         context.user_data["venta_id"] = compra_dict["id"]
         context.user_data["compra_info"] = compra_dict
         context.user_data.pop("venta_candidato", None)
-        est = estado_visual(compra_dict.get("fecha_devolucion", ""))
+        est = estado_visual(_dias_hasta(compra_dict.get("fecha_devolucion", "")))
         await query.edit_message_text(
             f"⚠️ *CONFIRMAR VENTA*\n\n"
             f"┌─────────────────────────\n"
@@ -1096,7 +2800,9 @@ async def recibir_metodo_pago(update: Update, context: ContextTypes.DEFAULT_TYPE
     compra_info = context.user_data.get("compra_info", {})
     fecha_venta = datetime.now().strftime("%d/%m/%Y")
 
-    exito, precio_compra = registrar_venta_completa(id_pedido, fecha_venta, precio_venta, metodo_nombre)
+    exito, precio_compra = await en_hilo_sheets(
+        registrar_venta_completa, id_pedido, fecha_venta, precio_venta, metodo_nombre
+    )
 
     if exito:
         ganancia = precio_venta - precio_compra
@@ -1153,7 +2859,7 @@ async def procesar_foto_review(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("❌ Envía una imagen del producto", reply_markup=None)
         return ESPERANDO_REVIEW_FOTOS
 
-    photo = update.message.photo[-1]
+    photo = _elegir_foto(update.message.photo)
     file = await photo.get_file()
     foto_id = f"review_{update.message.chat_id}_{update.message.message_id}_{random.randint(1000, 9999)}.jpg"
     image_path = f"/tmp/{foto_id}"
@@ -1255,7 +2961,7 @@ async def recibir_uso_review(update: Update, context: ContextTypes.DEFAULT_TYPE)
     msg = await query.edit_message_text("⏳ Analizando imágenes y generando reseñas auténticas...")
 
     try:
-        review_text = generar_review_con_gemini_multiples_imagenes(image_paths, estrellas, uso, producto)
+        review_text = await generar_review_con_gemini_multiples_imagenes(image_paths, estrellas, uso, producto)
         await msg.edit_text(
             f"📝 *REVIEW GENERADA*\n\n{review_text}",
             parse_mode="Markdown",
@@ -1306,12 +3012,11 @@ async def recibir_id_eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE
         await manejar_mensaje_texto(update, context)
         return ConversationHandler.END
 
-    compra = buscar_compra_por_id_para_eliminar(texto_id)
+    compra = await en_hilo_sheets(buscar_compra_por_id_para_eliminar, texto_id)
 
     if isinstance(compra, Compra):
-        context.user_data["eliminar_fila"] = compra.fila
         context.user_data["eliminar_id"] = compra.id
-        est = estado_visual(compra.fecha_devolucion)
+        est = estado_visual(compra.dias)
 
         await update.message.reply_text(
             f"🗑️ *CONFIRMAR ELIMINACIÓN*\n\n"
@@ -1347,7 +3052,6 @@ async def confirmar_eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE)
     data = query.data
 
     if data == "cancel_del":
-        context.user_data.pop("eliminar_fila", None)
         context.user_data.pop("eliminar_id", None)
         await query.edit_message_text("❌ Eliminación cancelada.")
         await context.bot.send_message(
@@ -1358,14 +3062,13 @@ async def confirmar_eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     if data.startswith("confirm_del_"):
-        fila = context.user_data.get("eliminar_fila")
         id_pedido = context.user_data.get("eliminar_id")
 
-        if not fila:
+        if not id_pedido:
             await query.edit_message_text("❌ Error: No se encontró la información para eliminar.")
             return ConversationHandler.END
 
-        if eliminar_compra_por_fila(fila):
+        if await en_hilo_sheets(eliminar_compra_por_id, id_pedido):
             await query.edit_message_text(
                 f"✅ *ELIMINADO*\n\nEl registro `{id_pedido}` ha sido eliminado permanentemente.",
                 parse_mode="Markdown",
@@ -1381,7 +3084,6 @@ async def confirmar_eliminar(update: Update, context: ContextTypes.DEFAULT_TYPE)
             text="¿Siguiente acción?",
             reply_markup=get_inline_compra_venta_buttons(),
         )
-        context.user_data.pop("eliminar_fila", None)
         context.user_data.pop("eliminar_id", None)
         return ConversationHandler.END
 
@@ -1411,7 +3113,7 @@ async def detectar_respuesta_rapida(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text("❌ No pude identificar el ID del pedido en el mensaje.")
             return True
 
-        compra = buscar_compra_por_id_exacto(id_pedido)
+        compra = await en_hilo_sheets(buscar_compra_por_id_exacto, id_pedido)
         if not compra:
             await update.message.reply_text("❌ Pedido no encontrado en la base de datos.")
             return True
@@ -1442,7 +3144,7 @@ async def detectar_respuesta_rapida(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text("❌ No pude identificar el ID del pedido en el mensaje.")
             return True
 
-        compra = buscar_compra_por_id_exacto(id_pedido)
+        compra = await en_hilo_sheets(buscar_compra_por_id_exacto, id_pedido)
         if not compra:
             await update.message.reply_text("❌ Pedido no encontrado en la base de datos.")
             return True
@@ -1453,7 +3155,7 @@ async def detectar_respuesta_rapida(update: Update, context: ContextTypes.DEFAUL
             await update.message.reply_text("⚠️ Este pedido ya fue vendido, no se puede devolver.")
             return True
 
-        est = estado_visual(compra.fecha_devolucion)
+        est = estado_visual(compra.dias)
         await update.message.reply_text(
             f"⚠️ *CONFIRMAR DEVOLUCIÓN*\n\n"
             f"┌─────────────────────────\n"
@@ -1516,7 +3218,9 @@ async def procesar_metodo_rapido(update: Update, context: ContextTypes.DEFAULT_T
     compra_info = context.user_data.get("compra_info", {})
     fecha_venta = datetime.now().strftime("%d/%m/%Y")
 
-    exito, precio_compra = registrar_venta_completa(id_pedido, fecha_venta, precio_venta, metodo_nombre)
+    exito, precio_compra = await en_hilo_sheets(
+        registrar_venta_completa, id_pedido, fecha_venta, precio_venta, metodo_nombre
+    )
 
     if exito:
         ganancia = precio_venta - precio_compra
@@ -1551,16 +3255,16 @@ async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if not autorizado(update):
         return
     await reply(update, "📦 Cargando inventario...")
-    items = obtener_todo_inventario()
+    items = await en_hilo_sheets(obtener_todo_inventario)
 
     if not items:
         await reply(update, "📭 No hay artículos registrados.", reply_markup=get_inline_compra_venta_buttons())
         return
 
     # Contadores para el resumen
-    en_stock = [i for i in items if i["estado"] not in ("vendido", "devuelto")]
-    vendidos  = [i for i in items if i["estado"] == "vendido"]
-    devueltos = [i for i in items if i["estado"] == "devuelto"]
+    en_stock = [i for i in items if i.estado not in ("vendido", "devuelto")]
+    vendidos  = [i for i in items if i.estado == "vendido"]
+    devueltos = [i for i in items if i.estado == "devuelto"]
 
     LIMITE = 3800  # margen seguro bajo el límite de 4096 de Telegram
     chat_id = update.effective_chat.id
@@ -1568,23 +3272,23 @@ async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     # ── Construir cada entrada COMPLETA primero ──────────────────────────────
     entradas: list[str] = []
     for item in items:
-        estado = item["estado"]
+        estado = item.estado
 
         if estado == "vendido":
-            detalle = f"💵 Vendido: ${item['precio_venta']}" if item.get("precio_venta") else ""
-            metodo  = f"  •  {item['metodo_pago']}" if item.get("metodo_pago") else ""
+            detalle = f"💵 Vendido: ${item.precio_venta}" if item.precio_venta else ""
+            metodo  = f"  •  {item.metodo_pago}" if item.metodo_pago else ""
             estado_badge = f"✅  *VENDIDO*{('  —  ' + detalle + metodo) if detalle else ''}"
         elif estado == "devuelto":
             estado_badge = "🔄  *DEVUELTO*"
         else:
-            est = estado_visual(item.get("fecha_devolucion", ""))
+            est = estado_visual(item.dias)
             estado_badge = f"🟢  *EN STOCK*  —  Dev: {est}"
 
         entradas.append(
             f"┌─────────────────────────\n"
-            f"│ 🆔 `{item['id']}`\n"
-            f"│ 📦 {item['producto']}\n"
-            f"│ 💰 Compra: ${item['precio_compra']}\n"
+            f"│ 🆔 `{item.id}`\n"
+            f"│ 📦 {item.producto}\n"
+            f"│ 💰 Compra: ${item.precio_compra}\n"
             f"│ {estado_badge}\n"
             f"└─────────────────────────\n"
         )
@@ -1635,7 +3339,7 @@ async def inventario(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def _procesar_devolucion(update: Update, termino: str) -> None:
     """Lógica compartida de búsqueda y confirmación para /dev."""
     msg = await update.message.reply_text(f"🔄 Buscando *{termino}*...", parse_mode="Markdown")
-    compra = buscar_compra_por_id(termino)
+    compra = await en_hilo_sheets(buscar_compra_por_id, termino)
 
     # Resultado exacto (ID completo)
     if isinstance(compra, Compra):
@@ -1645,7 +3349,7 @@ async def _procesar_devolucion(update: Update, termino: str) -> None:
         if compra.estado == "vendido":
             await msg.edit_text(f"⚠️ El pedido `{compra.id}` ya fue vendido, no se puede devolver.", parse_mode="Markdown")
             return
-        est = estado_visual(compra.fecha_devolucion)
+        est = estado_visual(compra.dias)
         await msg.edit_text(
             f"⚠️ *CONFIRMAR DEVOLUCIÓN*\n\n"
             f"┌─────────────────────────\n"
@@ -1672,7 +3376,7 @@ async def _procesar_devolucion(update: Update, termino: str) -> None:
         if c.estado == "vendido":
             await msg.edit_text(f"⚠️ El pedido `{c.id}` ya fue vendido, no se puede devolver.", parse_mode="Markdown")
             return
-        est = estado_visual(c.fecha_devolucion)
+        est = estado_visual(c.dias)
         await msg.edit_text(
             f"⚠️ *CONFIRMAR DEVOLUCIÓN*\n\n"
             f"┌─────────────────────────\n"
@@ -1694,7 +3398,7 @@ async def _procesar_devolucion(update: Update, termino: str) -> None:
     if isinstance(compra, list) and len(compra) > 1:
         lista = "🔍 *Varios pedidos encontrados, usa el ID completo:*\n\n"
         for c in compra[:5]:
-            est = estado_visual(c.fecha_devolucion)
+            est = estado_visual(c.dias)
             lista += f"• `{c.id}`\n  📦 {c.producto[:30]}\n  📅 {est}\n\n"
         await msg.edit_text(lista, parse_mode="Markdown")
         return
@@ -1748,48 +3452,23 @@ async def recibir_id_dev(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 
-def _ejecutar_busqueda(termino: str) -> list[dict]:
+@_con_cache
+def _ejecutar_busqueda(termino: str) -> list[Compra]:
     """Lógica de búsqueda reutilizable."""
-    rows = _get_all_rows()
-    termino_lower = termino.lower()
-    es_id_completo = bool(ID_COMPLETO_RE.match(termino))
-    resultados: list[dict] = []
+    tabla = _get_all_rows()
 
-    for i, row in enumerate(rows[1:], 1):
-        if not row:
-            continue
-        id_pedido = row[0] if len(row) > 0 else ""
-        producto  = row[2] if len(row) > 2 else ""
-        estado    = row[8] if len(row) > 8 and row[8] else "pendiente"
-
-        if es_id_completo:
-            coincide = id_pedido == termino
-        elif termino.isdigit():
-            coincide = id_pedido.endswith(termino)
-        else:
-            coincide = termino_lower in producto.lower()
+    if ID_COMPLETO_RE.match(termino):
+        i = _buscar_indice_por_id(termino)
+        indices = [i] if i is not None else []
+    elif termino.isdigit():
+        indices = _buscar_indices_por_sufijo(termino)
+    else:
+        indices = _buscar_indices_por_producto(termino)
 
-        if coincide:
-            try:
-                fecha_dev = datetime.strptime(row[4], "%d/%m/%Y") if len(row) > 4 and row[4] else None
-                dias = (fecha_dev - datetime.now()).days if fecha_dev else 9999
-            except Exception:
-                dias = 9999
-            resultados.append({
-                "id": id_pedido,
-                "producto": producto,
-                "precio_compra": row[3] if len(row) > 3 else "N/A",
-                "precio_venta": row[6] if len(row) > 6 else "",
-                "fecha_compra": row[1] if len(row) > 1 else "N/A",
-                "fecha_devolucion": row[4] if len(row) > 4 else "N/A",
-                "metodo_pago": row[7] if len(row) > 7 else "",
-                "estado": estado,
-                "_dias": dias,
-            })
-    return resultados
+    return [Compra(tabla, i) for i in indices if not tabla.vacias[i]]
 
 
-def _formato_resultados(termino: str, resultados: list[dict]) -> str:
+def _formato_resultados(termino: str, resultados: list[Compra]) -> str:
     texto = (
         f"🔍 *RESULTADOS — \"{termino}\"*\n"
         f"━━━━━━━━━━━━━━━━━━━━━━━━━\n"
@@ -1797,21 +3476,21 @@ def _formato_resultados(termino: str, resultados: list[dict]) -> str:
         f"━━━━━━━━━━━━━━━━━━━━━━━━━\n\n"
     )
     for item in resultados:
-        estado = item["estado"]
+        estado = item.estado
         if estado == "vendido":
-            detalle = f"💵 Vendido: ${item['precio_venta']}" if item.get("precio_venta") else ""
-            metodo  = f"  •  {item['metodo_pago']}" if item.get("metodo_pago") else ""
+            detalle = f"💵 Vendido: ${item.precio_venta}" if item.precio_venta else ""
+            metodo  = f"  •  {item.metodo_pago}" if item.metodo_pago else ""
             badge   = f"✅  *VENDIDO*{('  —  ' + detalle + metodo) if detalle else ''}"
         elif estado == "devuelto":
             badge = "🔄  *DEVUELTO*"
         else:
-            est   = estado_visual(item.get("fecha_devolucion", ""))
+            est   = estado_visual(item.dias)
             badge = f"🟢  *EN STOCK*  —  Dev: {est}"
         texto += (
             f"┌─────────────────────────\n"
-            f"│ 🆔 `{item['id']}`\n"
-            f"│ 📦 {item['producto']}\n"
-            f"│ 💰 Compra: ${item['precio_compra']}\n"
+            f"│ 🆔 `{item.id}`\n"
+            f"│ 📦 {item.producto}\n"
+            f"│ 💰 Compra: ${item.precio_compra}\n"
             f"│ {badge}\n"
             f"└─────────────────────────\n"
         )
@@ -1829,10 +3508,11 @@ async def iniciar_buscar(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Tiene argumento directo → buscar y terminar
         msg = await update.message.reply_text(f"🔍 Buscando *{termino}*...", parse_mode="Markdown")
         try:
-            resultados = _ejecutar_busqueda(termino)
+            resultados = await en_hilo_sheets(_ejecutar_busqueda, termino)
             if not resultados:
                 await msg.edit_text(
-                    f"❌ No se encontró ningún pedido con *{termino}*\n\nPrueba con otro término.",
+                    f"❌ No se encontró ningún pedido con *{termino}*\n\n"
+                    f"Prueba con otro término o busca en lo archivado: `/arc {termino}`",
                     parse_mode="Markdown", reply_markup=get_main_keyboard(),
                 )
             else:
@@ -1873,11 +3553,11 @@ async def recibir_termino_busqueda(update: Update, context: ContextTypes.DEFAULT
 
     msg = await update.message.reply_text(f"🔍 Buscando *{termino}*...", parse_mode="Markdown")
     try:
-        resultados = _ejecutar_busqueda(termino)
+        resultados = await en_hilo_sheets(_ejecutar_busqueda, termino)
         if not resultados:
             await msg.edit_text(
                 f"❌ No se encontró ningún pedido con *{termino}*\n\n"
-                "Prueba con otro término o usa /bus de nuevo.",
+                f"Prueba con otro término, usa /bus de nuevo o busca en lo archivado: `/arc {termino}`",
                 parse_mode="Markdown", reply_markup=get_main_keyboard(),
             )
         else:
@@ -1896,12 +3576,64 @@ async def recibir_termino_busqueda(update: Update, context: ContextTypes.DEFAULT
 buscar_pedido = iniciar_buscar
 
 
+async def buscar_archivo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """/arc — búsqueda en la pestaña de archivo (pedidos cerrados hace tiempo)."""
+    if not autorizado(update):
+        return
+
+    termino = " ".join(context.args).strip() if context.args else ""
+    if not termino:
+        await reply(
+            update,
+            "🗄️ Uso: `/arc <nombre o dígitos del ID>`\nBusca en los pedidos archivados.",
+            parse_mode="Markdown",
+        )
+        return
+
+    msg = await update.message.reply_text(f"🗄️ Buscando *{termino}* en el archivo...", parse_mode="Markdown")
+    try:
+        resultados = await en_hilo_sheets(buscar_en_archivo, termino)
+        if not resultados:
+            await msg.edit_text(
+                f"❌ No hay pedidos archivados con *{termino}*",
+                parse_mode="Markdown", reply_markup=get_main_keyboard(),
+            )
+        else:
+            await msg.edit_text(
+                _formato_resultados(f"{termino} (archivo)", resultados),
+                parse_mode="Markdown", reply_markup=get_inline_compra_venta_buttons(),
+            )
+    except Exception as e:
+        logger.error(f"Error buscar en archivo: {e}")
+        await msg.edit_text("❌ Error al buscar en el archivo.", reply_markup=None)
+
+
 
 
 
+async def sincronizar_sheets(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job periódico: trae de Sheets lo que haya cambiado fuera del bot."""
+    try:
+        # Comparte la revalidación con la que hayan lanzado las lecturas, si hay una en curso
+        await asyncio.wrap_future(_revalidar_en_fondo())
+    except Exception as e:
+        logger.warning(f"Error sincronizando con Sheets: {e}")
+
+
+async def archivar_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Job nocturno: pasa a la pestaña de archivo los pedidos cerrados hace más de ARCHIVO_DIAS."""
+    try:
+        archivados = await en_fondo_sheets(archivar_cerrados)
+        if archivados:
+            logger.info(f"Archivados {archivados} pedidos cerrados en '{ARCHIVO_HOJA}'")
+    except Exception as e:
+        logger.error(f"Error archivando pedidos cerrados: {e}")
+
+
 async def alerta_diaria(context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
-        productos = obtener_productos_por_vencer(5)
+        # La alerta diaria consulta Sheets (proyectado) para no depender de la última sincronización
+        productos = await en_fondo_sheets(obtener_productos_por_vencer, 5, desde_sheets=True)
         if not productos:
             return
 
@@ -1956,7 +3688,7 @@ async def manejar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if data.startswith("confirm_dev_"):
         await query.answer()
         id_pedido = data.replace("confirm_dev_", "")
-        if marcar_como_devuelto(id_pedido):
+        if await en_hilo_sheets(marcar_como_devuelto, id_pedido):
             await query.edit_message_text(
                 f"✅ *DEVUELTO*\n\n"
                 f"🆔 `{id_pedido}`\n"
@@ -1978,7 +3710,7 @@ async def manejar_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if data.startswith("confirm_dev_rapido_"):
         await query.answer()
         id_pedido = data.replace("confirm_dev_rapido_", "")
-        if marcar_como_devuelto(id_pedido):
+        if await en_hilo_sheets(marcar_como_devuelto, id_pedido):
             await query.edit_message_text(
                 f"✅ *DEVUELTO*\n\n🆔 `{id_pedido}`\nMarcado como devuelto correctamente.",
                 parse_mode="Markdown",
@@ -2177,10 +3909,32 @@ async def post_init(application: Application) -> None:
         BotCommand("del", "Eliminar registro"),
         BotCommand("inv", "Ver inventario completo"),
         BotCommand("bus", "Buscar pedido por nombre o ID"),
+        BotCommand("arc", "Buscar en pedidos archivados"),
         BotCommand("dev", "Marcar pedido como devuelto"),
         BotCommand("ayu", "Ayuda"),
         BotCommand("cancelar", "Cancelar"),
     ])
+    _aviso["bot"], _aviso["loop"] = application.bot, asyncio.get_running_loop()
+    if not DATOS_DIR:
+        logger.warning("Sin DATOS_DIR ni volumen: snapshot desactivado y extracciones solo en memoria")
+    # En segundo plano: el bot empieza a atender mientras tanto (las lecturas esperan al lock)
+    application.create_task(en_hilo_sheets(precalentar))
+
+
+async def post_shutdown(application: Application) -> None:
+    # Que ninguna venta/devolución en cola se pierda al reiniciar el worker
+    if not await en_hilo_sheets(vaciar_escrituras) and _escrituras["pendientes"]:
+        if SNAPSHOT_PATH:
+            logger.error(f"Quedaron {len(_escrituras['pendientes'])} escrituras sin enviar; van en el snapshot")
+        else:
+            # Sin volumen no hay dónde guardarlas: al menos que queden en el log para rehacerlas
+            logger.error(f"Escrituras sin enviar a Sheets (F:I por pedido): {_escrituras['pendientes']}")
+    # Snapshot con lo último (y lo que no se pudo enviar) para el próximo arranque
+    await en_hilo_sheets(_guardar_snapshot)
+    _sheets_executor.shutdown(wait=True)
+    logger.info(f"Sheets: {resumen_metricas_sheets()}")
+    await cerrar_gemini()
+    _imagen_executor.shutdown(wait=True)
 
 
 def main() -> None:
@@ -2199,13 +3953,25 @@ def main() -> None:
     print("🤖 Bot Optimizado v5.0")
     print(f"✅ Chat ID permitido: {TU_CHAT_ID}")
 
-    application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.job_queue.run_daily(
         alerta_diaria,
         time=datetime.strptime("20:00", "%H:%M").time(),
         days=(0, 1, 2, 3, 4, 5, 6),
     )
+    application.job_queue.run_repeating(sincronizar_sheets, interval=CACHE_TTL, first=CACHE_TTL)
+    application.job_queue.run_daily(
+        archivar_job,
+        time=datetime.strptime("04:00", "%H:%M").time(),
+        days=(0, 1, 2, 3, 4, 5, 6),
+    )
 
     # Handler de cancelar por texto libre (funciona dentro de conversaciones)
     cancelar_texto_handler = MessageHandler(
@@ -2329,6 +4095,7 @@ def main() -> None:
     application.add_handler(CommandHandler(["start"], start))
     application.add_handler(CommandHandler(["ayuda", "ayu"], ayuda))
     application.add_handler(CommandHandler(["inventario", "inv", "lis"], inventario))
+    application.add_handler(CommandHandler(["archivo", "arc"], buscar_archivo))
     application.add_handler(CommandHandler(["cancelar", "can"], cancelar))
     application.add_handler(MessageHandler(filters.PHOTO & ~filters.COMMAND, manejar_foto))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, manejar_mensaje_texto))